@@ -18,8 +18,11 @@ logging.debug(f'Running: {__name__}')
 
 import os
 import sys
+import copy
 
 from aqt import mw
+
+from .media import DEFAULT_IMG_ENCODER
 # from .template import *
 # from .template import iocard_front_ao, iocard_back_ao, iocard_css_ao, iocard_front_oa, iocard_back_oa, iocard_css_oa
 
@@ -140,7 +143,12 @@ IO_MODELS_MAP = {
         'skip_flds': ['ext_q', 'ext_a', 'ext_mnem'],
         'io_flds_priv': ['id', 'im', 'qm', 'om'], # fields that aren't user-editable
         'io_flds_prsv': ['sc'], # fields that are synced between an IO Editor session and Anki's Editor
-        'sort_fld': 1 # set sortfield to header
+        'sort_fld': 1, # set sortfield to header
+        'img_encoder': dict(DEFAULT_IMG_ENCODER), # format of question/answer images
+        # 'full': question and answer image per card, 'compact': one image
+        # per card with the question shapes drawn over it, 'clip': no images,
+        # cards show their region of the Image field with the shapes over it
+        'img_mode': 'full'
     },
     'sli': {
         'short_name': 'sli',
@@ -169,7 +177,12 @@ IO_MODELS_MAP = {
         'skip_flds': ['ext_q', 'ext_a', 'ext_mnem'],
         'io_flds_priv': ['id', 'im', 'qm', 'om'], # fields that aren't user-editable
         'io_flds_prsv': ['sc'], # fields that are synced between an IO Editor session and Anki's Editor
-        'sort_fld': 1 # set sortfield to header
+        'sort_fld': 1, # set sortfield to header
+        'img_encoder': dict(DEFAULT_IMG_ENCODER), # format of question/answer images
+        # 'full': question and answer image per card, 'compact': one image
+        # per card with the question shapes drawn over it, 'clip': no images,
+        # cards show their region of the Image field with the shapes over it
+        'img_mode': 'full'
     },
     
 }
@@ -191,10 +204,12 @@ IO_HOTKEY = "Ctrl+Shift+O"
 
 # default configurations
 # TODO: update version number before release
-default_conf_local = {'version': 0.02,
+default_conf_local = {'version': 0.03,
                       'dir': IO_HOME,
-                      'hotkey': IO_HOTKEY}
-default_conf_syncd = {'version': 0.02,
+                      'hotkey': IO_HOTKEY,
+                      'parallel_gen': False, # build SI/LI/SLI masks in worker threads
+                      'gen_workers': 0} # number of worker threads, 0 means one per core
+default_conf_syncd = {'version': 0.03,
                       'ofill': '7f007f',
                       'qfill': '393e46', # fill for regular question masks
                       'rev_qfill': '393e46', # fill for reverse question masks
@@ -208,6 +223,8 @@ default_conf_syncd = {'version': 0.02,
                       'font': 'Arial',
                       'fsize': 24,
                       'only_mod_buttons': True, # if True, it removes/disables glutanimate's occlusion buttons
+                      'sparse_masks': False, # SI/LI/SLI masks only hold the shapes of their card
+                      'client_masks': False, # AO/OA cards derive their masks from the original mask
                       'io_models_map': IO_MODELS_MAP}
 
 ONLY_MOD_BUTTONS = default_conf_syncd['only_mod_buttons']
@@ -227,7 +244,14 @@ def getSyncedConfig():
         print("Updating config DB from earlier IO release")
         for key in list(default_conf_syncd.keys()):
             if key not in mw.col.conf['imgocc_armod']:
-                mw.col.conf['imgocc_armod'][key] = default_conf_syncd[key]
+                mw.col.conf['imgocc_armod'][key] = copy.deepcopy(default_conf_syncd[key])
+        # settings added to the note types of an earlier release
+        models_map = mw.col.conf['imgocc_armod']['io_models_map']
+        for short_name, model_map in default_conf_syncd['io_models_map'].items():
+            models_map.setdefault(short_name, {})
+            for key in model_map:
+                if key not in models_map[short_name]:
+                    models_map[short_name][key] = copy.deepcopy(model_map[key])
         mw.col.conf['imgocc_armod']['version'] = default_conf_syncd['version']
         mw.col.setMod()
 
@@ -238,9 +262,9 @@ def getLocalConfig():
     # Local preferences
     if 'imgocc_armod' not in mw.pm.profile:
         mw.pm.profile["imgocc_armod"] = default_conf_local
-    elif mw.pm.profile['imgocc_armod'].get('version', 0) < default_conf_syncd['version']:
+    elif mw.pm.profile['imgocc_armod'].get('version', 0) < default_conf_local['version']:
         for key in list(default_conf_local.keys()):
-            if key not in mw.col.conf['imgocc_armod']:
+            if key not in mw.pm.profile['imgocc_armod']:
                 mw.pm.profile["imgocc_armod"][key] = default_conf_local[key]
         mw.pm.profile['imgocc_armod']['version'] = default_conf_local['version']
 
@@ -0,0 +1,854 @@
+# -*- coding: utf-8 -*-
+
+"""
+Builds the question and answer masks of SI/LI/SLI notes out of the
+original occlusion mask.
+
+This module must stay free of aqt/anki imports.
+"""
+
+import logging
+logging.debug(f'Running: {__name__}')
+
+import re
+import math
+import hashlib
+import collections
+import itertools
+import concurrent.futures
+import threading
+import xml.etree.ElementTree as ET
+from PIL import Image, ImageColor, ImageDraw
+
+from .media import openImage, png_encoder
+
+SVG_NS = 'http://www.w3.org/2000/svg'
+
+# visibility states of mask elements
+STATE_HIDDEN = 0 # not part of the current card
+STATE_VISIBLE = 1 # root, layers, titles and groups holding questions
+STATE_QUESTION = 2 # occluded on the question side, translucent on the answer side
+STATE_HIDER = 3 # occludes parts of the image on both sides
+
+COORD_DECIMALS = 2 # precision of coordinates in sparse masks
+# attributes whose numbers are rounded in sparse masks
+GEOMETRY_ATTRS = {'x', 'y', 'width', 'height', 'cx', 'cy', 'r', 'rx', 'ry',
+                  'x1', 'y1', 'x2', 'y2', 'd', 'points', 'transform',
+                  'stroke-width', 'font-size'}
+_NUMBER_RE = re.compile(r'(-?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)')
+
+# images of LI/SLI cards: 'full' rasterizes a question and an answer image,
+# 'compact' one image with the question shapes in an overlay per side and
+# 'clip' no image at all, cards show a region of the source image under
+# overlays holding the question shapes and hiders
+IMG_MODES = ('full', 'compact', 'clip')
+
+# question and answer side of a card, q_img/a_img are only set for LI/SLI.
+# Compact LI/SLI cards have a single image in q_img, clipped ones none, and
+# overlay holds the SVG drawn on top of it on each side.
+CardMasks = collections.namedtuple('CardMasks', ['qmask', 'amask', 'q_img', 'a_img',
+                                                 'overlay'], defaults=(None,))
+# clip is ((left, top, right, bottom), source image size) of clipped cards
+Overlay = collections.namedtuple('Overlay', ['q_svg', 'a_svg', 'clip'], defaults=(None,))
+
+PARALLEL_MIN_CARDS = 8 # starting worker threads doesn't pay off below this
+
+
+def encodeImg(img_obj, encoder=png_encoder):
+    """Return image as media.EncodedImage, None stays None"""
+    if img_obj is None:
+        return None
+    return encoder.encode(img_obj)
+
+
+def ns(tagname):
+    """Qualify tag name with the SVG namespace"""
+    return '{%s}%s' % (SVG_NS, tagname)
+
+
+def svgToString(svg_node):
+    """Serialize svg tree with SVG as the default (prefix-less) namespace"""
+    try:
+        return ET.tostring(svg_node, encoding='unicode',
+                           default_namespace=SVG_NS)
+    except ValueError:
+        # tree contains elements outside of the SVG namespace, fall back
+        # to stripping the auto-generated ns0 prefix
+        xml_str = ET.tostring(svg_node, encoding='unicode')
+        return ''.join(re.split("ns0:|:ns0", xml_str))
+
+
+def fillClass(fill_key):
+    """
+    Class of shapes filled with the configured colour fill_key, the card
+    CSS maps it to a variable (see template.py)
+    """
+    return 'io-' + fill_key.replace('_', '-')
+
+
+def quantize(value, decimals=COORD_DECIMALS):
+    """Round all numbers in an attribute value to decimals places"""
+    parts = _NUMBER_RE.split(value)
+    for i in range(1, len(parts), 2):
+        num = ('%.*f' % (decimals, float(parts[i]))).rstrip('0').rstrip('.')
+        num = '0' if num == '-0' else num
+        if i > 1 and not parts[i - 1] and not num.startswith('-'):
+            num = ' ' + num # was separated by a leading dot or sign only
+        parts[i] = num
+    return ''.join(parts)
+
+
+class MaskEmitter(object):
+    """
+    Parses an occlusion mask once and emits any number of question/answer
+    variants of it.
+
+    Every element gets a base state once: root, layers and layer titles are
+    visible, everything else is hidden. A variant only lists the elements
+    whose state differs from that (see emit()), so building it costs a
+    single serialization pass over the tree.
+
+    With sparse=True a variant is emitted without its hidden elements and
+    with rounded coordinates, so its size no longer grows with the number
+    of shapes in the mask. It renders the same.
+    """
+
+    def __init__(self, svg, hider_col='#FFFFFF', sparse=False):
+        self.svg_node = ET.fromstring(svg)
+        self.layer_nodes = self.svg_node.findall('*')
+        self.hider_col = hider_col
+        self.sparse = sparse
+        assert (self.svg_node.tag == ns('svg'))
+        assert (len(self.layer_nodes) >= 1)
+        # last, i.e. top-most element, needs to be a layer:
+        assert (self.layer_nodes[-1].tag == ns('g'))
+
+        self.states = {elm: STATE_HIDDEN for elm in self.svg_node.iter()}
+        self.states[self.svg_node] = STATE_VISIBLE
+        for layer_node in self.layer_nodes:
+            self.states[layer_node] = STATE_VISIBLE
+            if len(layer_node) and layer_node[0].tag == ns('title'):
+                self.states[layer_node[0]] = STATE_VISIBLE
+        self._touched = {}
+        self._appended = []
+        for elm, state in self.states.items():
+            self._applyState(elm, state, "Q")
+        self._touched = {} # base states are kept across variants
+        if sparse:
+            self._order = {elm: i for i, elm in enumerate(self.svg_node.iter())}
+            self._parents = {child: parent for parent in self.svg_node.iter()
+                             for child in parent}
+
+    def set(self, elm, attr, value):
+        """Set attribute of elm for the current variant only"""
+        if elm not in self._touched:
+            self._touched[elm] = dict(elm.attrib)
+        elm.set(attr, value)
+
+    def unset(self, elm, attr):
+        """Remove attribute of elm for the current variant only"""
+        if attr in elm.attrib:
+            if elm not in self._touched:
+                self._touched[elm] = dict(elm.attrib)
+            del elm.attrib[attr]
+
+    def append(self, parent, elm):
+        """Append elm to parent for the current variant only"""
+        parent.append(elm)
+        self._appended.append((parent, elm))
+
+    def emit(self, states=None, side="Q"):
+        """
+        Return variant as a string and reset the tree
+
+        states maps elements to the state they take on in this variant,
+        all other elements keep their base state
+        """
+        if states:
+            for elm, state in states.items():
+                self._applyState(elm, state, side)
+        if self.sparse:
+            xml = svgToString(self._sparseTree(states or {}))
+        else:
+            xml = svgToString(self.svg_node)
+        self.reset()
+        return xml
+
+    def _sparseTree(self, states):
+        """
+        Copy of the current variant holding only the elements that show,
+        their ancestors, defs and appended elements
+        """
+        shown = [elm for elm, state in states.items()
+                 if state != STATE_HIDDEN and self._ancestorsShown(elm, states)]
+        shown.sort(key=self._order.__getitem__) # keep the stacking order
+        root = ET.Element(self.svg_node.tag, self.svg_node.attrib)
+        copies = {self.svg_node: root}
+        for defs in self.svg_node.findall(ns('defs')):
+            root.append(defs) # referenced by id, whether hidden or not
+        for elm in shown:
+            self._sparseCopy(elm, copies)
+        for parent, elm in self._appended:
+            self._sparseCopy(parent, copies).append(
+                ET.Element(elm.tag, self._quantizedAttrib(elm)))
+        return root
+
+    def _ancestorsShown(self, elm, states):
+        parent = self._parents.get(elm)
+        while parent is not None:
+            if states.get(parent, self.states[parent]) == STATE_HIDDEN:
+                return False
+            parent = self._parents.get(parent)
+        return True
+
+    def _sparseCopy(self, elm, copies):
+        """Copy of elm (without children) inside the copy of its parent"""
+        if elm not in copies:
+            parent_copy = self._sparseCopy(self._parents[elm], copies)
+            copies[elm] = ET.SubElement(parent_copy, elm.tag,
+                                        self._quantizedAttrib(elm))
+            if elm.text and elm.text.strip():
+                copies[elm].text = elm.text
+        return copies[elm]
+
+    def _quantizedAttrib(self, elm):
+        return {attr: quantize(value) if attr in GEOMETRY_ATTRS else value
+                for attr, value in elm.attrib.items()}
+
+    def reset(self):
+        """Roll back all changes made since the last emit()"""
+        for parent, elm in reversed(self._appended):
+            parent.remove(elm)
+        self._appended = []
+        for elm, attrib in self._touched.items():
+            elm.attrib.clear()
+            elm.attrib.update(attrib)
+        self._touched = {}
+
+    def _applyState(self, elm, state, side):
+        if state == STATE_HIDDEN:
+            self.set(elm, 'opacity', '0')
+        elif state == STATE_VISIBLE:
+            self.unset(elm, 'opacity')
+        elif state == STATE_QUESTION:
+            # heavy fill on the question side, slight fill on the answer side
+            self.set(elm, 'opacity', '1' if side == "Q" else '0.3')
+        elif state == STATE_HIDER:
+            self.set(elm, 'opacity', '1')
+            # hider_col, not the hider_fill of images, so the mask colours
+            # of the note type CSS don't apply to it
+            self.set(elm, 'fill', self.hider_col)
+            self.set(elm, 'class', 'hider')
+
+
+class SIMaskBuilder(object):
+    """
+    Builds the question and answer masks of SI cards.
+
+    A card is (kind, index): ('regular', q_idx), ('reverse', (qset_idx, q_idx))
+    or ('blank', q_idx). Both sides of a card are built in one pass, the
+    question's elements, states and wrapper are looked up once and shared
+    by Q and A. CardMasks fields listed in unused are left None and cost
+    nothing to build.
+    """
+    kinds = ('regular', 'reverse')
+    keep_answer_fill = False # A masks of regular questions keep the original fill
+
+    def __init__(self, svg, fills, image_path=None, sparse=False, unused=(),
+                 img_mode='full'):
+        self.fills = fills
+        self.image_path = image_path
+        self.unused = frozenset(unused)
+        self.img_mode = img_mode # LI/SLI only, one of IMG_MODES
+        self.emitter = MaskEmitter(svg, fills['hider_col'], sparse)
+        self.svg_node = self.emitter.svg_node
+        self._src_img = None
+        self._src_size = None
+
+    def build(self, card):
+        """Return CardMasks of card"""
+        (kind, idx) = card
+        if kind == 'regular':
+            return self._buildRegular(idx)
+        elif kind == 'reverse':
+            return self._buildReverse(*idx)
+        elif kind == 'blank' and kind in self.kinds:
+            return self._buildBlank(idx)
+        raise ValueError(f'{self.__class__.__name__} cannot build {kind} cards')
+
+    def _buildRegular(self, q_idx):
+        fills = self.fills
+        mlayer_node = self.emitter.layer_nodes[-1]  # treat topmost layer as masks layer
+        q_elm = mlayer_node[q_idx] # elm might be rect/g/path/shape
+        q_wrapper = mlayer_node[q_idx + 1]
+        states = self._regularStates(q_elm)
+        inversed_wrapper = self.inverse_wrapper(q_wrapper, self.svg_node, fills['regular_inverse_fill'])
+        (q_img, a_img, overlay) = self._cardImages(q_wrapper, states, (fills['qfill'], 255), # 255 means no transparency
+                                                   (fills['afill'], 50))
+
+        self._markQuestion(q_elm, states, 'qshape', 'qfill')
+        qmask = self._emit(states, "Q", inversed_wrapper)
+        a_fill = None if self.keep_answer_fill else 'afill'
+        self._markQuestion(q_elm, states, 'ashape', a_fill)
+        amask = self._emit(states, "A", inversed_wrapper)
+        return CardMasks(qmask, amask, q_img, a_img, overlay)
+
+    def _buildReverse(self, qset_idx, q_idx):
+        fills = self.fills
+        rlayer_node = self.emitter.layer_nodes[-2]  # treat 2nd topmost layer as reverse masks layer
+        qset_elm = rlayer_node[qset_idx] # g is question set
+        q_elm = qset_elm[q_idx] # this is a single question -> rect/g
+        q_wrapper = rlayer_node[qset_idx + 1]
+        states = self._reverseStates(qset_elm, q_elm)
+        inversed_wrapper = self.inverse_wrapper(q_wrapper, self.svg_node, fills['regular_inverse_fill'])
+        (q_img, a_img, overlay) = self._cardImages(q_wrapper, self._reverseImageStates(states),
+                                                   (fills['rev_qfill'], 255), (fills['rev_afill'], 50))
+
+        self.emitter.set(qset_elm, 'class', 'qset')
+        self._markQuestion(q_elm, states, 'qshape', 'rev_qfill')
+        qmask = self._emit(states, "Q", inversed_wrapper)
+        if inversed_wrapper is not None:
+            inversed_wrapper.set('fill', fills['reverse_inverse_fill'])
+        self.emitter.set(qset_elm, 'class', 'qset')
+        self._markQuestion(q_elm, states, 'qshape', 'rev_afill')
+        amask = self._emit(states, "A", inversed_wrapper)
+        return CardMasks(qmask, amask, q_img, a_img, overlay)
+
+    def _regularStates(self, q_elm):
+        """Return states of a regular question's elements in document order"""
+        if q_elm.get('fill'): # elms except g
+            return {q_elm: STATE_QUESTION}
+        states = {q_elm: STATE_VISIBLE} # elms only g
+        for q_shape in q_elm.findall('*'):
+            if q_shape.get('fill') != 'none': # these are q shapes
+                states[q_shape] = STATE_QUESTION
+            else: # these are ommitting shapes, shape fill is set to none
+                states[q_shape] = STATE_HIDER
+        return states
+
+    def _reverseStates(self, qset_elm, q_elm):
+        """
+        Return states of a single question of a question set, question
+        shapes first, then the hiders of the set
+        """
+        states = {qset_elm: STATE_VISIBLE}
+        if q_elm.get('fill'): # elms except g
+            states[q_elm] = STATE_QUESTION
+        else: # elms only g
+            states[q_elm] = STATE_VISIBLE
+            for q_shape in q_elm.findall('*'):
+                states[q_shape] = STATE_QUESTION
+        for elm in qset_elm.findall('*'): # hiders are shared by the whole set
+            if elm.get('fill') == 'none':
+                states[elm] = STATE_HIDER
+        return states
+
+    def _reverseImageStates(self, states):
+        """States of a reverse question painted onto its images"""
+        return states
+
+    def _markQuestion(self, q_elm, states, q_class, fill_key):
+        """
+        Set class and fill of question shapes to the colour fill_key of
+        self.fills, fill_key=None keeps the fill
+        """
+        self.emitter.set(q_elm, 'class', q_class)
+        for elm, state in states.items():
+            if state == STATE_QUESTION:
+                self.emitter.set(elm, 'class', q_class)
+                if fill_key:
+                    self.emitter.set(elm, 'class', f'{q_class} {fillClass(fill_key)}')
+                    self.emitter.set(elm, 'fill', self.fills[fill_key])
+
+    def _emit(self, states, side, inversed_wrapper=None):
+        if ('qmask' if side == "Q" else 'amask') in self.unused:
+            self.emitter.reset() # drop the changes made for this side
+            return None
+        if inversed_wrapper is not None:
+            self.emitter.append(self.svg_node, inversed_wrapper)
+        return self.emitter.emit(states, side)
+
+    def _cardImages(self, q_wrapper, states, q_paint, a_paint):
+        """Return question and answer image and overlay of a card, None if unused"""
+        if {'q_img', 'a_img'} <= self.unused:
+            return (None, None, None)
+        (q_img, a_img) = self._wrapperImages(q_wrapper, states, q_paint, a_paint)
+        return (None if 'q_img' in self.unused else q_img,
+                None if 'a_img' in self.unused else a_img, None)
+
+    def _wrapperImages(self, q_wrapper, states, *paints):
+        """Return an image of the card painted with each of paints, SI cards have none"""
+        return (None,) * len(paints)
+
+    def inverse_wrapper(self, wrapper_elm, root_elm, fill_col): # wrapper should be shape or path, not g
+        if wrapper_elm.tag == ns('rect'):
+            r_height = float(root_elm.get('height'))
+            r_width = float(root_elm.get('width'))
+
+            w_x = float(wrapper_elm.get('x'))
+            w_y = float(wrapper_elm.get('y'))
+            w_height = float(wrapper_elm.get('height'))
+            w_width = float(wrapper_elm.get('width'))
+        # demo  structure
+        #   <rect x="100" y="100" width="300" height="100" style="fill:rgb(0,0,255);stroke-width:3;stroke:rgb(0,0,0)" />
+        #   <path d="m0,0 800,0 l0,800## l-800,0## l0,-700## l95,0 l0,105 l310,0## l0,-110 l-310,0 l0,5 l-95,0 z" stroke="green" stroke-width="3"
+        #   fill="none" />
+
+            path_d = f"m0,0 l{r_width},0 l0,{r_height} l{-r_width},0 l0,{-(r_height-w_y)} l{w_x-5},0 l0,{w_height+5} l{w_width+10},0 l0,{-(w_height+10)} l{-(w_width+10)},0 l0,5 l{-(w_x-5)},0 z"
+            inversed_elm = ET.Element(ns('path'), attrib={'id': 'inversed_wrapper', 'd': path_d, 'fill': fill_col})
+            return inversed_elm
+
+
+class LIMaskBuilder(SIMaskBuilder):
+    """Builds masks and question/answer images of LI cards"""
+    keep_answer_fill = True
+
+    def srcImg(self):
+        """Source image, decoded once and shared, never modify it in place"""
+        if self._src_img is None:
+            self._src_img = openImage(self.image_path)
+            logging.debug(f'self.image_path: {self.image_path}')
+            logging.debug(f'src_img: {self._src_img}')
+        return self._src_img
+
+    def srcSize(self):
+        """Size of the source image, read from its header unless it is decoded"""
+        if self._src_size is None:
+            if self._src_img is not None:
+                self._src_size = self._src_img.size
+            else:
+                with Image.open(self.image_path) as src_img:
+                    self._src_size = src_img.size
+        return self._src_size
+
+    def _cardImages(self, q_wrapper, states, q_paint, a_paint):
+        """
+        Compact cards get one image with just the hiders painted, the
+        question shapes go into an overlay per side. Clipped cards get
+        no image, their overlays hold the hiders too.
+        """
+        if self.img_mode == 'full':
+            return SIMaskBuilder._cardImages(self, q_wrapper, states, q_paint, a_paint)
+        if {'q_img', 'a_img'} <= self.unused:
+            return (None, None, None)
+        if self.img_mode == 'clip':
+            return self._clipImages(q_wrapper, states, q_paint, a_paint)
+        hiders = {elm: state for elm, state in states.items() if state == STATE_HIDER}
+        (img,) = self._wrapperImages(q_wrapper, hiders, (None, 255))
+        if img is None:
+            return (None, None, None)
+        place = self._maskPlace(q_wrapper)
+        overlay = Overlay(*(self._overlaySvg(states, img.size, paint, *place)
+                            for paint in (q_paint, a_paint)))
+        return (img, None, overlay)
+
+    def _clipImages(self, q_wrapper, states, q_paint, a_paint):
+        """Overlays of the wrapper area of the source image, nothing is rasterized"""
+        area = self.get_wrapper_area(q_wrapper)
+        if area is None:
+            return (None, None, None)
+        # same pixels as the crop of the other modes, crop() rounds the area
+        box = tuple(round(coord) for coord in area)
+        size = (box[2] - box[0], box[3] - box[1])
+        place = self._maskPlace(q_wrapper)
+        holes = self._wrapperHoles(q_wrapper, box)
+        overlay = Overlay(*(self._overlaySvg(states, size, paint, *place,
+                                             hiders=True, holes=holes)
+                            for paint in (q_paint, a_paint)),
+                          clip=(box, self.srcSize()))
+        return (None, None, overlay)
+
+    def _wrapperHoles(self, q_wrapper, box):
+        """Areas of box the card shows if it hides all the rest of it, None shows all"""
+        return None
+
+    def _wrapperImages(self, q_wrapper, states, *paints):
+        """Crop the wrapper once and paint the masks of each paint onto their own copy"""
+        # get question wrapper img
+        q_img = self.get_qwrapper_img(q_wrapper, self.srcImg())
+        images = [q_img] + [q_img.copy() for _ in paints[1:]]
+        for paint, img in zip(paints, images):
+            self._pasteMaskImgs(states, paint, img, q_wrapper)
+        return tuple(images)
+
+    def _maskPlace(self, q_wrapper):
+        """Arguments of get_mask_box() placing masks on the wrapper image"""
+        return (q_wrapper,)
+
+    def _overlaySvg(self, states, size, paint, *place, hiders=False, holes=None):
+        """
+        SVG of the question shapes in states, and their hiders if hiders is
+        set, laid over an image of size. The shapes cover the same pixels
+        as in _pasteMaskImgs. Everything outside of holes is hidden on top.
+        """
+        svg = ET.Element(ns('svg'), {
+            'viewBox': '0 0 %d %d' % size, 'preserveAspectRatio': 'none',
+            'style': 'position:absolute;left:0;top:0;width:100%;height:100%'})
+        for elm, state in states.items():
+            if state == STATE_QUESTION:
+                (fill, alpha_ch) = paint
+            elif state == STATE_HIDER and hiders:
+                (fill, alpha_ch) = (self.fills['hider_fill'], 255)
+            else:
+                continue
+            (left, top, (width, height)) = self.get_mask_box(elm, *place)
+            attrib = {'x': str(left), 'y': str(top), 'width': str(width),
+                      'height': str(height), 'fill': fill}
+            if alpha_ch != 255:
+                attrib['fill-opacity'] = quantize(str(alpha_ch / 255), 3)
+            if elm.get('transform'):
+                # the mask image is rotated around its center and pasted with
+                # its expanded bounding box at (left, top)
+                angle = self._angle(elm)
+                (cos, sin) = (abs(math.cos(math.radians(angle))),
+                              abs(math.sin(math.radians(angle))))
+                (cx, cy) = (left + (width*cos + height*sin) / 2,
+                            top + (width*sin + height*cos) / 2)
+                attrib['x'] = quantize(str(cx - width / 2))
+                attrib['y'] = quantize(str(cy - height / 2))
+                attrib['transform'] = quantize(f'rotate({angle} {cx} {cy})')
+            ET.SubElement(svg, ns('rect'), attrib)
+        if holes is not None:
+            path_d = 'M0 0H%dV%dH0Z' % size + ''.join(
+                'M%s %sH%sV%sH%sZ' % (left, top, right, bottom, left)
+                for (left, top, right, bottom) in holes)
+            ET.SubElement(svg, ns('path'), {'d': quantize(path_d), 'fill-rule': 'evenodd',
+                                            'fill': self.fills['hider_fill']})
+        return svgToString(svg)
+
+    def _angle(self, q_elm):
+        """Rotation of q_elm in degrees, svg-edit writes it first in transform"""
+        return float(q_elm.get('transform').split()[0].split('(')[1])
+
+    def _pasteMaskImgs(self, states, paint, dest_img, *place):
+        """Paste image masks of question shapes and hiders in states order"""
+        (fill, alpha_ch) = paint
+        # one draw context for all shapes, see create_mask_img
+        draw = ImageDraw.Draw(dest_img, 'RGBA') if dest_img.mode == 'RGB' else None
+        for elm, state in states.items():
+            if state == STATE_QUESTION:
+                self.create_mask_img(elm, fill, alpha_ch, dest_img, *place, draw=draw)
+            elif state == STATE_HIDER:
+                self.create_mask_img(elm, self.fills['hider_fill'], 255, dest_img, *place, draw=draw)
+
+    def create_mask_img(self, q_elm, fill, alpha_ch, q_wrapper_img, *place, draw=None):
+        """Process mask image"""
+        (left, top, (width, height)) = self.get_mask_box(q_elm, *place)
+        if draw is not None and not q_elm.get('transform'):
+            # drawing a translucent rectangle onto an RGB image blends exactly
+            # like pasting a mask image, without allocating one per shape
+            if width > 0 and height > 0:
+                draw.rectangle((left, top, left+width-1, top+height-1),
+                               fill=ImageColor.getcolor(fill, 'RGB') + (alpha_ch,))
+            return
+        q_mask = Image.new('RGB', (width, height), fill)
+        q_mask.putalpha(alpha_ch)
+        # rotate image
+        if q_elm.get('transform'):
+            q_mask = q_mask.rotate(-self._angle(q_elm), expand=True)
+        q_wrapper_img.paste(q_mask, (left, top), mask=q_mask)
+
+    def get_mask_box(self, q_elm, q_wrapper_svg):
+        """Position of q_elm's mask on the wrapper image and its size before rotation"""
+        # PIL.Image.new() doesn't accept float coordinates, hence we're working with int coords.
+        (qe_width, qe_height) = (float(q_elm.get('width')), float(q_elm.get('height'))) # Error Raises if Reverse pattern is applied on regular layer
+        (qe_x, qe_y) = (float(q_elm.get('x')), float(q_elm.get('y'))) # qe means q_elm
+        # calculate relative position for q_mask
+        (qw_x, qw_y) = (float(q_wrapper_svg.get('x')), float(q_wrapper_svg.get('y')))
+        (left, top) = (int(qe_x-qw_x)+1, int(qe_y-qw_y)+1)
+        return (left, top, (int(qe_width), int(qe_height)))
+
+    def get_qwrapper_img(self, q_wrapper, src_img):
+        qw_crop_area = self.get_wrapper_area(q_wrapper)
+        cropped_qw = src_img.crop(qw_crop_area)
+        return cropped_qw
+
+    def get_wrapper_area(self, q_wrapper):
+        """(left, top, right, bottom) of the source image the card shows"""
+        (qw_x, qw_y, qw_width, qw_height) = (float(q_wrapper.get('x')), float(q_wrapper.get('y')), # qw means q_wrapper
+                                            float(q_wrapper.get('width')), float(q_wrapper.get('height')))
+        return (qw_x, qw_y, qw_x+qw_width, qw_y+qw_height)
+
+
+class SLIMaskBuilder(LIMaskBuilder):
+    """Builds masks and question/answer images of SLI cards"""
+    kinds = ('regular', 'reverse', 'blank')
+
+    def _buildBlank(self, q_idx):
+        fills = self.fills
+        blayer_node = self.emitter.layer_nodes[-3]  # treat topmost 3rd layer as blankQ masks layer
+        q_elm = blayer_node[q_idx] # elm is a rect
+        states = {q_elm: STATE_QUESTION}
+
+        self.emitter.set(q_elm, 'class', 'qshape')
+        if q_elm.get('fill'):
+            self.emitter.set(q_elm, 'class', 'qshape ' + fillClass('qfill'))
+            self.emitter.set(q_elm, 'fill', fills['qfill'])
+        qmask = self._emit(states, "Q")
+        self.emitter.set(q_elm, 'class', 'ashape')
+        amask = self._emit(states, "A")
+        if self.img_mode == 'clip': # the card draws the blank image
+            blank_svg = ET.Element(ns('svg'), {'width': '200', 'height': '50'})
+            ET.SubElement(blank_svg, ns('rect'), {'width': '100%', 'height': '100%',
+                                                  'fill': fills['blankq_fill']})
+            blank_svg = svgToString(blank_svg)
+            return CardMasks(qmask, amask, None, None, Overlay(blank_svg, blank_svg))
+        # blank image for q and a
+        blank_im = Image.new('RGB', (200, 50), fills['blankq_fill'])
+        if self.img_mode == 'compact': # the blank image is the same on both sides
+            return CardMasks(qmask, amask, blank_im, None, Overlay('', ''))
+        return CardMasks(qmask, amask,
+                         None if 'q_img' in self.unused else blank_im,
+                         None if 'a_img' in self.unused else blank_im.copy())
+
+    def _reverseImageStates(self, states):
+        """
+        SLI reverse images never showed the hiders of their question set,
+        they were painted after the wrapper was cropped
+        """
+        return {elm: state for elm, state in states.items() if state != STATE_HIDER}
+
+    def inverse_wrapper(self, wrapper_elm, root_elm, fill_col):
+        # TODO implement svg wrapping, inversed wrapper is currently disabled
+        return None
+
+    def _wrapperImages(self, q_wrapper, states, *paints):
+        """
+        Crop the area around the wrapper once and paint the masks of each
+        paint onto their own copy of it, never copying the whole source image
+        """
+        qwrapper_area = self.get_qwrapper_area(q_wrapper)
+        if qwrapper_area is None:
+            return (None,) * len(paints)
+        q_img = self.srcImg().crop(qwrapper_area)
+        # crop() rounds the area, masks are placed relative to the result
+        offset = (round(qwrapper_area[0]), round(qwrapper_area[1]))
+        images = []
+        for paint, img in zip(paints, [q_img] + [q_img.copy() for _ in paints[1:]]):
+            self._pasteMaskImgs(states, paint, img, offset)
+            if q_wrapper.tag == ns('g'): # multiple qwrapper
+                img = self.remove_backgrounds(q_wrapper.findall('*'), self.fills['hider_fill'],
+                                              img, qwrapper_area)
+            images.append(img)
+        return tuple(images)
+
+    def remove_backgrounds(self, sub_qwrappers_svg, hider_fill, big_qwrect_img, big_qwrect_area):
+        # bqwrect means big question wrapper rectangle
+        (bqwrect_left, bqwrect_top, bqwrect_right, bqwrect_bottom) = big_qwrect_area
+        (bqwrect_width, bqwrect_height) = (bqwrect_right - bqwrect_left, bqwrect_bottom - bqwrect_top)
+        new_bqwrect = Image.new('RGB', (int(bqwrect_width) + 1, int(bqwrect_height) + 1), hider_fill)
+        for sqw in sub_qwrappers_svg:
+            # calculate relative position for sub_qwrapper
+            (sqw_x, sqw_y, sqw_width, sqw_height) = (float(sqw.get('x')), float(sqw.get('y')),
+                                                     float(sqw.get('width')), float(sqw.get('height')))
+            (sqw_left, sqw_top, sqw_right, sqw_bottom) = (sqw_x, sqw_y, # absolute coords
+                                                            sqw_x + sqw_width, sqw_y + sqw_height)
+            (sqw_left, sqw_top, sqw_right, sqw_bottom) = (sqw_left - bqwrect_left, # relative coords
+                                sqw_top - bqwrect_top, sqw_right - bqwrect_left, sqw_bottom - bqwrect_top) #bqwrect_right - sqw_right, bqwrect_bottom - sqw_bottom)
+            cropped_sqw = big_qwrect_img.crop((sqw_left, sqw_top, sqw_right, sqw_bottom))
+            new_bqwrect.paste(cropped_sqw, (int(sqw_left), int(sqw_top)))
+        return new_bqwrect
+
+    def get_mask_box(self, q_elm, offset=(0, 0)):
+        """Position of q_elm's mask on an image placed at offset in the source image"""
+        # PIL.Image.new() doesn't accept float coordinates, hence we're working with int coords.
+        (qe_width, qe_height) = (float(q_elm.get('width')), float(q_elm.get('height'))) # Error Raises if Reverse pattern is applied on regular layer
+        (qe_x, qe_y) = (float(q_elm.get('x')), float(q_elm.get('y'))) # qe means q_elm
+        (left, top) = (int(qe_x)+1-offset[0], int(qe_y)+1-offset[1])
+        return (left, top, (int(qe_width)+1, int(qe_height)+1))
+
+    def _wrapperHoles(self, q_wrapper, box):
+        """Sub-wrappers of a multiple qwrapper, everything else is hidden as in remove_backgrounds"""
+        if q_wrapper.tag != ns('g'):
+            return None
+        holes = []
+        for sqw in q_wrapper.findall('*'):
+            (sqw_x, sqw_y) = (float(sqw.get('x')) - box[0], float(sqw.get('y')) - box[1])
+            holes.append((sqw_x, sqw_y, sqw_x + float(sqw.get('width')),
+                          sqw_y + float(sqw.get('height'))))
+        return holes
+
+    def get_wrapper_area(self, q_wrapper):
+        return self.get_qwrapper_area(q_wrapper)
+
+    def _maskPlace(self, q_wrapper):
+        qwrapper_area = self.get_qwrapper_area(q_wrapper)
+        return ((round(qwrapper_area[0]), round(qwrapper_area[1])),)
+
+    def get_surrounding_rect_from_sub_rects(self, sub_rects_svg):
+        big_rect_left = sorted([float(i.get('x')) for i in sub_rects_svg])[0] # smallest x
+        big_rect_top = sorted([float(i.get('y')) for i in sub_rects_svg])[0] # smallest y
+        big_rect_right = sorted([float(i.get('x'))+float(i.get('width')) for i in sub_rects_svg])[-1] # biggest x+width
+        big_rect_bottom = sorted([float(i.get('y'))+float(i.get('height')) for i in sub_rects_svg])[-1] # biggest y+height
+        return (big_rect_left, big_rect_top, big_rect_right, big_rect_bottom)
+
+    def get_qwrapper_area(self, q_wrapper):
+        """Area covered by a question wrapper, q_wrapper is either a rect or a g of rects"""
+        if q_wrapper.tag == ns('rect'): # single qwrapper
+            (qw_x, qw_y, qw_width, qw_height) = (float(q_wrapper.get('x')), float(q_wrapper.get('y')),
+                                                 float(q_wrapper.get('width')), float(q_wrapper.get('height')))
+            return (qw_x, qw_y, qw_x+qw_width, qw_y+qw_height)
+        elif q_wrapper.tag == ns('g'): # multiple qwrapper
+            return self.get_surrounding_rect_from_sub_rects(q_wrapper.findall('*'))
+
+
+XLINK_NS = 'http://www.w3.org/1999/xlink'
+# root attribute of original masks, settings key of the session's cards
+GEN_SETTINGS_ATTRIB = 'data-imgocc-settings'
+
+
+def _canonicalValue(value):
+    """Attribute value independent of number formatting and whitespace"""
+    try:
+        return repr(float(value))
+    except ValueError:
+        return ' '.join(value.split())
+
+
+def _canonicalAttribs(elm):
+    attribs = []
+    for name, value in elm.attrib.items():
+        if name.startswith('{') and not name.startswith('{%s}' % XLINK_NS):
+            continue # editor metadata (svg-edit's se:* etc.)
+        attribs.append((name, _canonicalValue(value)))
+    return sorted(attribs)
+
+
+def _hashElement(sha, elm, deep=True):
+    """Feed tag, attributes and text of elm (and its subtree) into sha"""
+    sha.update(repr((elm.tag, _canonicalAttribs(elm),
+                     (elm.text or '').strip())).encode('utf8'))
+    if deep:
+        for child in elm:
+            _hashElement(sha, child)
+        sha.update(b'/') # end of subtree
+
+
+def svgFingerprint(svg):
+    """
+    Return a fingerprint of an occlusion mask
+
+    It only depends on the document itself, not on how it was serialized:
+    attribute order, number formatting, whitespace and namespace prefixes
+    are ignored.
+    """
+    sha = hashlib.sha1()
+    _hashElement(sha, ET.fromstring(svg))
+    return sha.hexdigest()
+
+
+def withGenSettings(svg, settings):
+    """
+    Original mask svg recording the settings key its cards were built
+    with, see cardSignatures. An empty key (the defaults) isn't recorded.
+    """
+    svg_node = ET.fromstring(svg)
+    svg_node.attrib.pop(GEN_SETTINGS_ATTRIB, None)
+    if settings:
+        svg_node.set(GEN_SETTINGS_ATTRIB, settings)
+    return svgToString(svg_node)
+
+
+def _signature(canvas, *elms, shallow=()):
+    sha = hashlib.sha1(repr(canvas).encode('utf8'))
+    for elm in shallow:
+        _hashElement(sha, elm, deep=False)
+    for elm in elms:
+        if elm is not None:
+            _hashElement(sha, elm)
+    return sha.hexdigest()
+
+
+def cardSignatures(svg, settings=None):
+    """
+    Return {note_id: signature} of every card of an occlusion mask
+
+    A signature covers what the visible part of a card's masks depends on:
+    canvas size, generation settings, question shapes, wrapper and, for
+    reverse questions, the question set and its hiders. Cards whose
+    signature didn't change in an edit don't have to be rebuilt. settings
+    defaults to the key recorded by withGenSettings.
+    """
+    svg_node = ET.fromstring(svg)
+    layer_nodes = svg_node.findall('*')
+    if settings is None:
+        settings = svg_node.get(GEN_SETTINGS_ATTRIB, '')
+    canvas = tuple(_canonicalValue(svg_node.get(attr, ''))
+                   for attr in ('width', 'height')) + (settings,)
+    signatures = {}
+
+    mnodes = layer_nodes[-1].findall('*')
+    for i, mnode in enumerate(mnodes):
+        if mnode.tag != ns('title') and i % 2 == 1 and mnode.get('id'):
+            q_wrapper = mnodes[i + 1] if i + 1 < len(mnodes) else None
+            signatures[mnode.get('id')] = _signature(canvas, mnode, q_wrapper)
+
+    if len(layer_nodes) >= 2:
+        rnodes = layer_nodes[-2].findall('*')
+        for i, rnode in enumerate(rnodes):
+            if rnode.tag != ns('g') or i % 2 != 1:
+                continue
+            q_wrapper = rnodes[i + 1] if i + 1 < len(rnodes) else None
+            hiders = [elm for elm in rnode if elm.get('fill') == 'none']
+            for q_elm in rnode:
+                if q_elm.get('fill') != 'none' and q_elm.get('id'):
+                    signatures[q_elm.get('id')] = _signature(
+                        canvas, q_elm, q_wrapper, *hiders, shallow=(rnode,))
+
+    if len(layer_nodes) >= 3:
+        for bnode in layer_nodes[-3].findall('*'):
+            if bnode.tag != ns('title') and bnode.get('id'):
+                signatures[bnode.get('id')] = _signature(canvas, bnode)
+    return signatures
+
+
+_worker_state = threading.local() # mask builder and encoder of a worker thread
+
+
+def _initWorker(builder_cls, svg, fills, image_path, encoder):
+    # builders keep per-card state in their emitter, each thread needs its own
+    _worker_state.builder = builder_cls(svg, fills, image_path)
+    _worker_state.encoder = encoder
+
+
+def _buildInWorker(card):
+    card_masks = _worker_state.builder.build(card)
+    # encode images in the worker as well, it's a good part of the work
+    return card_masks._replace(q_img=encodeImg(card_masks.q_img, _worker_state.encoder),
+                               a_img=encodeImg(card_masks.a_img, _worker_state.encoder))
+
+
+def iterCardsParallel(builder_cls, svg, fills, image_path, cards, workers,
+                      window=None, encoder=png_encoder):
+    """
+    Yield CardMasks of cards in order, built in a pool of worker threads
+
+    Threads rather than processes: Anki is a multithreaded Qt process, a
+    forked child may inherit a lock held by another thread and hang, and
+    spawning would start another instance of the frozen Anki binary.
+    Pillow releases the GIL while it crops, paints and encodes, which is
+    most of the work.
+
+    q_img/a_img are EncodedImages made by encoder. At most window cards
+    (default: two per worker) are built ahead of the consumer, so memory
+    stays bounded no matter how many cards there are. Stops early if no pool could be
+    used, callers then build the remaining cards serially.
+    """
+    window = window or workers * 2
+    cards = iter(cards)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, initializer=_initWorker,
+                initargs=(builder_cls, svg, fills, image_path, encoder)) as executor:
+            in_flight = collections.deque(
+                executor.submit(_buildInWorker, card)
+                for card in itertools.islice(cards, window))
+            while in_flight:
+                card_masks = in_flight.popleft().result()
+                for card in itertools.islice(cards, 1):
+                    in_flight.append(executor.submit(_buildInWorker, card))
+                yield card_masks
+    except (RuntimeError, concurrent.futures.BrokenExecutor) as e:
+        logging.warning(f'parallel mask generation failed, building serially: {e}')
+
+logging.debug(f'Exiting: {__name__}')
@@ -0,0 +1,524 @@
+# -*- coding: utf-8 -*-
+
+"""
+Writes generated card media (masks and question/answer images) to disk
+and caches decoded source images.
+
+This module must stay free of aqt/anki imports.
+"""
+
+import logging
+logging.debug(f'Running: {__name__}')
+
+import io
+import os
+import time
+import zlib
+import hashlib
+import struct
+import threading
+import collections
+import concurrent.futures
+
+from PIL import Image, ImageChops, features
+
+IMAGE_CACHE_BYTES = 256 * 1024 * 1024 # decoded pixels kept across sessions
+LARGE_IMAGE_PIXELS = 24 * 1024 * 1024 # PNGs above this are decoded in strips
+STRIP_ROWS = 256
+STRIP_CACHE_BYTES = 64 * 1024 * 1024 # decoded strips kept per image
+
+# encoder settings of generated card images, see ImageEncoder
+DEFAULT_IMG_ENCODER = {'format': 'png', # png, webp, webp_lossy, jpeg or auto
+                       'quality': 90, # webp_lossy and jpeg
+                       'effort': 4, # 0 (fastest) - 6 (smallest), webp only
+                       'budget_ms': 100} # auto: encoding time per image
+
+# name is the contentName() of the image before encoding
+EncodedImage = collections.namedtuple('EncodedImage', ['data', 'ext', 'name'],
+                                      defaults=(None,))
+
+MEDIA_PREFIX = 'imgocc' # of content addressed media file names
+
+
+def reduceImage(img):
+    """
+    Return img in the smallest pixel format that holds it losslessly
+
+    Opaque alpha channels are dropped, images of up to 256 colours become
+    palette images (PNG then uses 1, 2 or 4 bits per pixel for small
+    palettes) and gray RGB images become grayscale.
+    """
+    if 'transparency' in img.info or img.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        return img
+    if img.mode in ('RGBA', 'LA') and img.getchannel('A').getextrema() == (255, 255):
+        img = img.convert(img.mode[:-1])
+    if img.mode not in ('RGB', 'L'):
+        return img
+    colors = img.getcolors(256)
+    if colors and (len(colors) <= 16 or img.mode == 'RGB'):
+        palette = Image.new('P', (1, 1))
+        flat = []
+        for (_, color) in colors:
+            flat.extend((color,) * 3 if img.mode == 'L' else color)
+        palette.putpalette(flat)
+        reduced = img.convert('RGB').quantize(palette=palette, dither=0)
+        if _sameImage(reduced, img):
+            return reduced
+    if img.mode == 'RGB':
+        (red, green, blue) = img.split()
+        if _sameImage(red, green) and _sameImage(green, blue):
+            return red
+    return img
+
+
+def _sameImage(img, other):
+    return ImageChops.difference(img.convert(other.mode), other).getbbox() is None
+
+
+class ImageEncoder(object):
+    """
+    Encodes generated card images in the configured format
+
+    png, webp (lossless) and auto never change a pixel, webp_lossy and
+    jpeg trade quality for size. auto encodes an image as PNG and then as
+    lossless WebP as long as the expected time stays within budget_ms,
+    and keeps the smaller file. Formats the installed Pillow can't write
+    fall back to PNG.
+    """
+    exts = {'png': 'png', 'webp': 'webp', 'webp_lossy': 'webp', 'jpeg': 'jpg'}
+
+    def __init__(self, fmt='png', quality=90, effort=4, budget_ms=100):
+        if fmt not in self.exts and fmt != 'auto':
+            logging.warning(f'unknown image format {fmt}, using png')
+            fmt = 'png'
+        if fmt.startswith('webp') and not features.check('webp'):
+            logging.warning('Pillow was built without WebP support, using png')
+            fmt = 'png'
+        self.format = fmt
+        self.quality = min(100, max(0, int(quality)))
+        self.effort = min(6, max(0, int(effort)))
+        self.budget = budget_ms / 1000
+        self._webp_rate = None # seconds per pixel of lossless WebP, learned
+
+    @classmethod
+    def fromConfig(cls, conf):
+        """Encoder for a settings dict like DEFAULT_IMG_ENCODER"""
+        conf = dict(DEFAULT_IMG_ENCODER, **(conf or {}))
+        return cls(conf['format'], conf['quality'], conf['effort'],
+                   conf['budget_ms'])
+
+    @property
+    def ext(self):
+        """File extension of encoded images, None if it depends on the image"""
+        if self.format == 'auto':
+            return None if features.check('webp') else 'png'
+        return self.exts[self.format]
+
+    def encode(self, img):
+        """Return img as EncodedImage"""
+        encoded = self._encode(reduceImage(img))
+        return encoded._replace(name=contentName(img, encoded.ext, self))
+
+    def _encode(self, img):
+        if self.format != 'auto':
+            return EncodedImage(self._save(img, self.format), self.ext)
+        start = time.perf_counter()
+        best = EncodedImage(self._save(img, 'png'), 'png')
+        if not features.check('webp'):
+            return best
+        pixels = img.width * img.height
+        spent = time.perf_counter() - start
+        if self._webp_rate is not None and spent + self._webp_rate * pixels > self.budget:
+            logging.debug(f'auto: skipping webp for {img.size}')
+            return best
+        start = time.perf_counter()
+        webp = self._save(img, 'webp')
+        self._webp_rate = (time.perf_counter() - start) / max(1, pixels)
+        if len(webp) < len(best.data):
+            best = EncodedImage(webp, 'webp')
+        return best
+
+    def _save(self, img, fmt):
+        buf = io.BytesIO()
+        alpha = img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info
+        if fmt == 'png':
+            img.save(buf, 'PNG')
+        elif fmt == 'webp':
+            # for lossless webp quality is the compression effort
+            img.convert('RGBA' if alpha else 'RGB').save(
+                buf, 'WEBP', lossless=True, quality=self.effort * 100 // 6,
+                method=self.effort)
+        elif fmt == 'webp_lossy':
+            img.convert('RGBA' if alpha else 'RGB').save(
+                buf, 'WEBP', quality=self.quality, method=self.effort)
+        elif alpha: # jpeg has no alpha channel
+            logging.debug('jpeg: image has transparency, using png')
+            img.save(buf, 'PNG')
+        else:
+            img.convert('L' if img.mode == 'L' else 'RGB').save(
+                buf, 'JPEG', quality=self.quality, optimize=True)
+        return buf.getvalue()
+
+
+png_encoder = ImageEncoder()
+
+
+def contentName(data, ext=None, encoder=png_encoder):
+    """
+    Content addressed file name of data as written by MediaWriter
+
+    Files of the same content get the same name, so they are stored once.
+    PIL images are hashed before encoding, together with the encoder
+    settings, so that they can still be encoded on a writer thread, and
+    keep their name once encoded. ext defaults to the extension of
+    encoded images.
+    """
+    if isinstance(data, EncodedImage) and data.name:
+        return data.name
+    sha = hashlib.sha1()
+    if isinstance(data, Image.Image):
+        ext = ext or encoder.ext
+        if ext is None:
+            raise ValueError('auto encoded images need to be encoded to be named')
+        sha.update(repr((encoder.format, encoder.quality, encoder.effort,
+                         data.mode, data.size, data.getpalette())).encode('utf8'))
+        sha.update(data.tobytes())
+    elif isinstance(data, EncodedImage):
+        ext = ext or data.ext
+        sha.update(data.data)
+    elif isinstance(data, str):
+        sha.update(data.encode('utf8'))
+    else:
+        sha.update(data)
+    return '%s-%s.%s' % (MEDIA_PREFIX, sha.hexdigest(), ext)
+
+
+def mediaBytes(data, encoder=png_encoder):
+    """
+    Content of a media file: data is either bytes, an EncodedImage, a str
+    (written as utf-8) or a PIL image, which is encoded with encoder
+    """
+    if isinstance(data, Image.Image):
+        return encoder.encode(data).data
+    elif isinstance(data, EncodedImage):
+        return data.data
+    elif isinstance(data, str):
+        return data.encode('utf8')
+    return data
+
+
+def sameContent(path, data):
+    """Whether the file at path holds data, compared by size and hash"""
+    try:
+        if os.path.getsize(path) != len(data):
+            return False
+        sha = hashlib.sha1()
+        with open(path, 'rb') as media_file:
+            for chunk in iter(lambda: media_file.read(1024 * 1024), b''):
+                sha.update(chunk)
+    except OSError:
+        return False
+    return sha.digest() == hashlib.sha1(data).digest()
+
+
+def syncDir(path):
+    """Make renames in directory path durable"""
+    try:
+        dir_fd = os.open(path, os.O_RDONLY)
+    except OSError: # directories can't be opened on Windows
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError as e:
+        logging.debug(f'could not sync {path}: {e}')
+    finally:
+        os.close(dir_fd)
+
+
+class MediaWriter(object):
+    """
+    Writes the media files of a session
+
+    A file is only written if the file at its path differs, so unchanged
+    files keep their mtime and aren't synced again. Files are written to
+    a temporary file that is renamed into place once it reached the disk,
+    so a path never holds a partial file. The renames are made durable by
+    sync(), once per directory. Safe to use from several threads.
+    """
+
+    def __init__(self):
+        self.written = 0 # bytes actually written
+        self.files = 0 # files written
+        self.unchanged = 0 # files skipped as they hold their data already
+        self._dirs = set() # directories with renames since the last sync()
+        self._lock = threading.Lock()
+
+    def write(self, path, data, encoder=png_encoder):
+        """
+        Write data, see mediaBytes(), to path unless it holds it already.
+        Encoding happens here, so that it runs on the writer thread, zlib
+        releases the GIL while compressing.
+        """
+        data = mediaBytes(data, encoder)
+        if sameContent(path, data):
+            logging.debug(f'unchanged: {path}')
+            with self._lock:
+                self.unchanged += 1
+            return path
+        tmp_path = '%s.%d.part' % (path, threading.get_ident())
+        try:
+            with open(tmp_path, 'wb') as media_file:
+                media_file.write(data)
+                media_file.flush()
+                os.fsync(media_file.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self._lock:
+            self.written += len(data)
+            self.files += 1
+            self._dirs.add(os.path.dirname(os.path.abspath(path)))
+        return path
+
+    def exists(self, path):
+        """
+        Whether a file is at path, which then counts as unchanged. Only for
+        content addressed paths, whose files never change.
+        """
+        if not os.path.exists(path):
+            return False
+        logging.debug(f'exists: {path}')
+        with self._lock:
+            self.unchanged += 1
+        return True
+
+    def sync(self):
+        """Make the renames of all files written so far durable"""
+        with self._lock:
+            (dirs, self._dirs) = (self._dirs, set())
+        for dir_path in dirs:
+            syncDir(dir_path)
+
+    def report(self):
+        return (f'{self.written} bytes in {self.files} media files written, '
+                f'{self.unchanged} unchanged')
+
+
+class WriteBehindQueue(object):
+    """
+    Bounded write-behind queue for card media
+
+    Files are encoded and written on a small thread pool while the caller
+    goes on building the next cards by media_writer. submit() blocks once
+    max_pending writes are in flight, which bounds the memory held by
+    queued images.
+    """
+
+    def __init__(self, media_writer=None, workers=None, max_pending=None):
+        self.media_writer = media_writer or MediaWriter()
+        workers = workers or min(4, os.cpu_count() or 1)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(max_pending or workers * 4)
+
+    def submit(self, path, data, encoder=png_encoder):
+        """Queue data to be written to path, returns a future of the path"""
+        # working directory might change before the write happens
+        path = os.path.abspath(path)
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self.media_writer.write, path, data, encoder)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def close(self):
+        """Wait for all queued writes and stop the writer threads"""
+        self._executor.shutdown(wait=True)
+
+
+class ImageCache(object):
+    """
+    LRU cache of decoded source images
+
+    Entries are keyed by path, mtime and size, so an image replaced on disk
+    is decoded again. Cached images are shared by all callers and must not
+    be modified in place.
+    """
+
+    def __init__(self, max_bytes=IMAGE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._images = collections.OrderedDict() # key: (image, nbytes)
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """Return decoded image at path"""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            if key in self._images:
+                self._images.move_to_end(key)
+                logging.debug(f'image cache hit: {path}')
+                return self._images[key][0]
+        img = Image.open(path)
+        if (img.width * img.height > LARGE_IMAGE_PIXELS and
+                PngStrips.supports(img)):
+            img = PngStrips(path, img)
+            nbytes = img.max_bytes
+        else:
+            img.load()
+            nbytes = img.width * img.height * len(img.getbands())
+        with self._lock:
+            for old_key in [k for k in self._images if k[0] == path]:
+                self._drop(old_key) # outdated version of the file
+            self._images[key] = (img, nbytes)
+            self._nbytes += nbytes
+            while self._nbytes > self.max_bytes and len(self._images) > 1:
+                self._drop(next(iter(self._images)))
+        return img
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self._nbytes = 0
+
+    def _drop(self, key):
+        self._nbytes -= self._images.pop(key)[1]
+
+
+class PngStrips(object):
+    """
+    Large PNG whose rows are only decoded where they are cropped
+
+    Supports crop() like a PIL image, decoding just the strips of
+    STRIP_ROWS rows the crop covers. The inflate state is checkpointed at
+    the start of every strip reached so far, so going back to a strip
+    doesn't decode the image from the top again. Decoded strips are kept
+    in an LRU cache of at most max_bytes.
+
+    Unfiltering is left to PIL: the filtered rows of a strip are handed to
+    its PNG decoder behind a copy of the last decoded row, which the
+    filters of the first row refer to.
+    """
+    modes = ('L', 'LA', 'RGB', 'RGBA') # 8 bits per sample only
+
+    @classmethod
+    def supports(cls, img):
+        """Whether img (opened, not loaded) can be decoded in strips"""
+        return (img.format == 'PNG' and img.mode in cls.modes and
+                len(img.tile) == 1 and img.tile[0][0] == 'zip' and
+                img.tile[0][3] == img.mode and not img.info.get('interlace'))
+
+    def __init__(self, path, img, max_bytes=STRIP_CACHE_BYTES):
+        self.path = path
+        self.mode = img.mode
+        self.size = img.size
+        self.info = dict(img.info)
+        self.max_bytes = max_bytes
+        self._stride = img.width * len(img.getbands())
+        self._idat = self._idatChunks()
+        # strip nr: (compressed pos, inflate state, unconsumed input, previous row)
+        self._checkpoints = {0: (0, zlib.decompressobj(), b'', bytes(self._stride))}
+        self._strips = collections.OrderedDict()
+        self._max_strips = max(1, max_bytes // (self._stride * STRIP_ROWS))
+
+    @property
+    def width(self):
+        return self.size[0]
+
+    @property
+    def height(self):
+        return self.size[1]
+
+    def crop(self, box):
+        """Same as PIL's Image.crop()"""
+        (x0, y0, x1, y1) = map(int, map(round, box))
+        img = Image.new(self.mode, (x1 - x0, y1 - y0))
+        img.info = dict(self.info)
+        first = max(y0, 0) // STRIP_ROWS
+        last = (min(y1, self.height) - 1) // STRIP_ROWS
+        for nr in range(first, last + 1):
+            top = nr * STRIP_ROWS
+            part = self._strip(nr).crop((x0, max(y0, top) - top, x1, min(y1, top + STRIP_ROWS) - top))
+            img.paste(part, (0, max(y0, top) - y0))
+        return img
+
+    def _strip(self, nr):
+        if nr in self._strips:
+            self._strips.move_to_end(nr)
+            return self._strips[nr]
+        start = max(i for i in self._checkpoints if i <= nr)
+        for i in range(start, nr + 1): # strips in between are needed for their state
+            self._strips[i] = self._decodeStrip(i)
+            self._strips.move_to_end(i)
+            while len(self._strips) > self._max_strips:
+                self._strips.popitem(last=False)
+        return self._strips[nr]
+
+    def _decodeStrip(self, nr):
+        """Decode strip nr from its checkpoint and checkpoint the next one"""
+        (pos, inflater, tail, prev_row) = self._checkpoints[nr]
+        inflater = inflater.copy() # keep the checkpoint reusable
+        rows = min(STRIP_ROWS, self.height - nr * STRIP_ROWS)
+        size = need = rows * (self._stride + 1) # each row starts with its filter type
+        filtered = []
+        with open(self.path, 'rb') as png_file:
+            while need > 0:
+                if not tail:
+                    tail = self._readIdat(png_file, pos, 65536)
+                    pos += len(tail)
+                data = inflater.decompress(tail, need) if tail else inflater.flush()
+                if not data and not tail:
+                    raise ValueError(f'truncated PNG: {self.path}')
+                tail = inflater.unconsumed_tail
+                filtered.append(data)
+                need -= len(data)
+        raw = b'\0' + prev_row + b''.join(filtered)[:size]
+        strip = Image.frombytes(self.mode, (self.width, rows + 1),
+                                zlib.compress(raw, 0), 'zip', self.mode)
+        strip = strip.crop((0, 1, self.width, rows + 1))
+        if nr + 1 not in self._checkpoints and rows == STRIP_ROWS:
+            last_row = strip.crop((0, rows - 1, self.width, rows)).tobytes()
+            self._checkpoints[nr + 1] = (pos, inflater.copy(), tail, last_row)
+        return strip
+
+    def _idatChunks(self):
+        """(file offset, length) of all IDAT chunks"""
+        chunks = []
+        with open(self.path, 'rb') as png_file:
+            png_file.seek(8) # signature
+            while True:
+                header = png_file.read(8)
+                if len(header) < 8:
+                    break
+                (length, chunk_type) = struct.unpack('>I4s', header)
+                if chunk_type == b'IDAT':
+                    chunks.append((png_file.tell(), length))
+                elif chunk_type == b'IEND':
+                    break
+                png_file.seek(length + 4, 1) # data and crc
+        return chunks
+
+    def _readIdat(self, png_file, pos, size):
+        """Read up to size bytes at pos of the concatenated IDAT data"""
+        for (offset, length) in self._idat:
+            if pos < length:
+                png_file.seek(offset + pos)
+                return png_file.read(min(size, length - pos))
+            pos -= length
+        return b''
+
+
+image_cache = ImageCache()
+
+
+def openImage(path):
+    """Decoded image at path, shared through image_cache"""
+    return image_cache.get(path)
+
+logging.debug(f'Exiting: {__name__}')
@@ -24,12 +24,14 @@ from xml.dom import minidom
 from .config import *
 from .dialogs import ioAskUser
 from .utils import img2path, fname2img
+from .media import MediaWriter
 
 
 class ImgOccNoteConverter(object):
     def __init__(self, browser):
         self.browser = browser
         self.occl_id_last = None
+        self._media = MediaWriter() # media files written by this conversion
         loadConfig(self)
 
     def convertNotes(self, nids):
@@ -61,6 +63,8 @@ class ImgOccNoteConverter(object):
                     continue
                 nids_by_nr[int(note_nr)] = nid
             self.idAndCorrelateNotes(nids_by_nr, occl_id)
+        self._media.sync()
+        logging.debug(self._media.report())
         converted = len(io_nids)
         tooltip("<b>%i</b> notes updated, <b>%i</b> skipped"
                 % (converted - skipped, filtered + skipped))
@@ -208,9 +212,7 @@ class ImgOccNoteConverter(object):
         """Write mask to file in media collection"""
         logging.debug("!saving %s, %s", note_id, mtype)
         mask_path = '%s-%s.svg' % (note_id, mtype)
-        mask_file = open(mask_path, 'w')
-        mask_file.write(mask.encode('utf-8'))
-        mask_file.close()
+        self._media.write(mask_path, mask)
         return mask_path
 
 
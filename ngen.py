@@ -24,14 +24,31 @@ from aqt.qt import *
 from aqt import mw
 from aqt.utils import tooltip
 from anki.notes import Note
+try:
+    from anki.collection import AddNoteRequest
+except ImportError:
+    AddNoteRequest = None # Anki < 2.1.55 adds notes one at a time
 
 from xml.dom import minidom
+import xml.etree.ElementTree as ET
+import functools
 import time
+import os
+import hashlib
 
 from .dialogs import ioAskUser
-from .utils import fname2img
+from .utils import fname2img, img2path, readNoteIds, sessionIndex
 from .config import *
 from .config import ONLY_MOD_BUTTONS
+from .template import (CLIENT_MASK_TYPES, MASK_COLOUR_TYPES,
+                       template_fields, update_client_masks,
+                       update_mask_colours, update_clip_imgs)
+from .media import (WriteBehindQueue, MediaWriter, contentName,
+                    ImageEncoder, EncodedImage, png_encoder)
+from .masks import (SIMaskBuilder, LIMaskBuilder, SLIMaskBuilder, svgToString,
+                    svgFingerprint, cardSignatures, iterCardsParallel,
+                    withGenSettings, fillClass, quantize, IMG_MODES,
+                    PARALLEL_MIN_CARDS, GEN_SETTINGS_ATTRIB)
 
 # Explanation of some of the variables:
 #
@@ -63,6 +80,71 @@ def genByKey(key, note_tp, old_occl_tp=None):
         return IoGenAO
 
 
+class NoteBatch(object):
+    """
+    Collects the notes created and updated in one IO session and writes
+    them to the collection in one go, with the bulk APIs of newer Anki
+    versions where available
+    """
+
+    def __init__(self, model, mflds, did, tags):
+        self.model = model
+        self.mflds = mflds
+        self.did = did
+        self.tags = tags
+        self._new = [] # fields of notes to create, in order
+        self._updated = {} # nid: fields of notes to update
+
+    def __len__(self):
+        return len(self._new) + len(self._updated)
+
+    def add(self, fields, nid=None):
+        """Queue note nid for updating with fields, or a new note if nid is None"""
+        if nid:
+            self._updated[nid] = dict(fields)
+        else:
+            self._new.append(dict(fields))
+
+    def commit(self):
+        """Write all queued notes to the collection, returns their nids"""
+        col = mw.col
+        notes = []
+        new_notes = []
+        for nid, fields in self._updated.items():
+            notes.append(self._fillNote(col.getNote(nid), fields))
+        if notes:
+            if hasattr(col, 'update_notes'):
+                col.update_notes(notes)
+            else:
+                for note in notes:
+                    note.flush()
+            logging.debug("!noteflush %s notes", len(notes))
+
+        if self._new:
+            self.model['did'] = self.did # deck of the new cards
+            new_notes = [self._fillNote(Note(col, self.model), fields)
+                         for fields in self._new]
+            if AddNoteRequest is not None and hasattr(col, 'add_notes'):
+                col.add_notes([AddNoteRequest(note=note, deck_id=self.did)
+                               for note in new_notes])
+            else:
+                for note in new_notes:
+                    col.addNote(note)
+            logging.debug("!notecreate %s notes", len(new_notes))
+        self._new = []
+        self._updated = {}
+        return [note.id for note in notes + new_notes]
+
+    def _fillNote(self, note, fields):
+        note.tags = self.tags
+        for i in self.mflds:
+            fname = i["name"]
+            if fname in fields:
+                # only update fields that have been modified
+                note[fname] = fields[fname]
+        return note
+
+
 class ImgOccNoteGenerator(object):
     """Generic note generator object"""
 
@@ -85,6 +167,9 @@ class ImgOccNoteGenerator(object):
         self.note_tp = note_tp
         loadConfig(self)
         self.mconfig = self.mconfigs[self.note_tp] # model config
+        self._batch = None # notes of the current session, see _startBatch
+        self._media = MediaWriter() # media files written by this session
+        self._template_flds = None # fields shown by the card templates, see _renders
 
     def generateNotes(self):
         """Generate new notes"""
@@ -101,16 +186,18 @@ class ImgOccNoteGenerator(object):
 
         self.new_svg = svg_node.toxml()  # write changes to svg
         omask_path = self._saveMask(self.new_svg, self.occl_id, "O")
-        qmasks = self._generateMaskSVGsFor("Q")
-        amasks = self._generateMaskSVGsFor("A")
+        (qmasks, amasks) = self._generateMasks()
         image_path = mw.col.media.addFile(self.image_path)
         img = fname2img(image_path)
 
         mw.checkpoint("Adding Image Occlusion Cards")
+        self._updateNoteType()
+        self._startBatch()
         for nr, idx in enumerate(self.mnode_indexes):
             note_id = self.mnode_ids[idx]
             self._saveMaskAndReturnNote(omask_path, qmasks[nr], amasks[nr],
                                         img, note_id)
+        self._commitBatch()
         tooltip("%s %s <b>added</b>" % self._cardS(len(qmasks)), parent=None)
         return state
 
@@ -121,8 +208,8 @@ class ImgOccNoteGenerator(object):
         self.occl_id = '%s-%s' % (self.uniq_id, self.occl_tp)
         omask_path = None
 
-        self._findAllNotes()
         (svg_node, mlayer_node) = self._getMnodesAndSetIds(True)
+        self._findAllNotes()
         if not self.mnode_ids:
             tooltip("No shapes left. You can't delete all cards.<br>\
                 Are you sure you set your masks correctly?")
@@ -140,14 +227,15 @@ class ImgOccNoteGenerator(object):
         if self.new_svg != old_svg or self.occl_tp != self.opref["occl_tp"]:
             # updated masks or occlusion type
             omask_path = self._saveMask(self.new_svg, self.occl_id, "O")
-            qmasks = self._generateMaskSVGsFor("Q")
-            amasks = self._generateMaskSVGsFor("A")
+            (qmasks, amasks) = self._generateMasks()
             state = "reset"
 
         image_path = mw.col.media.addFile(self.image_path)
         img = fname2img(image_path)
 
         logging.debug("mnode_indexes %s", self.mnode_indexes)
+        self._updateNoteType()
+        self._startBatch()
         for nr, idx in enumerate(self.mnode_indexes):
             logging.debug("=====================")
             logging.debug("nr %s", nr)
@@ -163,6 +251,7 @@ class ImgOccNoteGenerator(object):
             else:
                 self._saveMaskAndReturnNote(None, None, None,
                                             img, note_id, nid)
+        self._commitBatch()
         self._showUpdateTooltip(del_count, new_count)
         return state
 
@@ -255,17 +344,36 @@ class ImgOccNoteGenerator(object):
         return res
 
     def _findAllNotes(self):
-        """Get matching nids by ID"""
+        """Get matching nids by ID, the mask node IDs have to be read already"""
         old_occl_id = '%s-%s' % (self.uniq_id, self.opref["occl_tp"])
-        res = self._findByNoteId(old_occl_id)
+        id_fld = self.mconfig['ioflds']['id']
+        indexed = sessionIndex().lookup(old_occl_id)
+        rows = readNoteIds(list(indexed.keys()), id_fld)
+        card_ids = {note_id for note_id in self._cardNoteIds()
+                    if note_id and note_id.startswith(old_occl_id + '-')}
+        indexed_ids = {note_id for note_id, mod in indexed.values()}
+        # A subset is enough: notes of shapes deleted by this edit are still
+        # indexed and get resolved from the index like all others. Notes added
+        # by a sync belong to shapes of the synced mask, so they show up as
+        # card ids the index lacks, and notes modified elsewhere change the
+        # (note id, mod) rows.
+        if (not indexed or not card_ids <= indexed_ids or
+                {nid: (note_id, mod) for nid, mod, note_id in rows} != indexed):
+            # session not indexed yet or modified since, e.g. by a sync,
+            # which can also add notes the index doesn't know about
+            logging.debug("session index miss %s", old_occl_id)
+            res = self._findByNoteId(old_occl_id)
+            rows = readNoteIds(res, id_fld)
         self.nids = {}
-        for nid in res:
-            note_id = mw.col.getNote(nid)[self.mconfig['ioflds']['id']]
+        for nid, mod, note_id in rows:
             self.nids[note_id] = nid
         logging.debug('--------------------')
-        logging.debug("res %s", res)
         logging.debug("nids %s", self.nids)
 
+    def _cardNoteIds(self):
+        """Note IDs of the cards of the mask nodes read by _getMnodesAndSetIds"""
+        return list(self.mnode_ids.values())
+
     def _deleteAndIdNotes(self, mlayer_node):
         """
         Determine which mask nodes have been deleted or newly created and, depending
@@ -369,6 +477,31 @@ class ImgOccNoteGenerator(object):
             mw.col.remNotes(deleted_nids)
         return (del_count, new_count)
 
+    def _generateMasks(self):
+        """
+        Return question and answer masks of all cards. With client-side
+        masks cards derive them from the original mask and none are made.
+        """
+        unused = [None] * len(self.mnode_indexes)
+        if self._clientMasks():
+            update_client_masks(mw.col, self.mconfig['model'], self.occl_tp,
+                                self.mconfig['ioflds'], self.qfill)
+            return (unused, unused)
+        # masks the templates don't show aren't made at all
+        return (self._generateMaskSVGsFor("Q") if self._renders('qm') else unused,
+                self._generateMaskSVGsFor("A") if self._renders('am') else unused)
+
+    def _renders(self, fld_id):
+        """Whether the card templates of the note type show field fld_id"""
+        if self._template_flds is None:
+            self._template_flds = template_fields(self.mconfig['model'])
+        return self.mconfig['ioflds'].get(fld_id) in self._template_flds
+
+    def _clientMasks(self):
+        """Whether cards render their masks in the card template"""
+        return (self.occl_tp in CLIENT_MASK_TYPES and
+                self.sconf.get('client_masks', default_conf_syncd['client_masks']))
+
     def _generateMaskSVGsFor(self, side):
         """Generate a mask for each mask node"""
         masks = [self._createMask(side, node_index)
@@ -394,7 +527,8 @@ class ImgOccNoteGenerator(object):
             # set question class
             node.setAttribute("class", "qshape")
             if node.hasAttribute("fill"):
-                # set question color
+                # set question color, the class lets the card CSS override it
+                node.setAttribute("class", "qshape " + fillClass('qfill'))
                 node.setAttribute("fill", self.qfill)
             list(map(self._setQuestionAttribs, node.childNodes))
 
@@ -408,23 +542,32 @@ class ImgOccNoteGenerator(object):
                 self._removeAttribsRecursively(i, attrs)
 
     def _saveMask(self, mask, note_id, mtype):
-        """Write mask to file in media collection"""
+        """Write mask to file in media collection, named by its content"""
         logging.debug("!saving %s, %s", note_id, mtype)
         # media collection is the working directory:
-        mask_path = '%s-%s.svg' % (note_id, mtype)
-        mask_file = open(mask_path, 'wb')
-        mask_file.write(mask.encode('utf8'))
-        mask_file.close()
+        mask_path = contentName(mask, 'svg')
+        if self._media.exists(mask_path):
+            return mask_path
+        self._media.write(mask_path, mask)
         return mask_path
 
     def _save_img(self, img_obj, note_id, mtype):
-        """Write image in media collection"""
+        """Write image in media collection, named by its content"""
         logging.debug("!saving %s, %s", note_id, mtype)
+        encoder = self._imgEncoder()
+        if not isinstance(img_obj, EncodedImage):
+            img_obj = encoder.encode(img_obj)
         # media collection is the working directory:
-        img_path = '%s-%s.png' % (note_id, mtype)
-        img_obj.save(img_path)
+        img_path = contentName(img_obj)
+        if self._media.exists(img_path):
+            return img_path
+        self._media.write(img_path, img_obj)
         return img_path
 
+    def _imgEncoder(self):
+        """Encoder of generated images, configured per note type"""
+        return png_encoder
+
     def removeBlanks(self, node):
         for x in node.childNodes:
             if x.nodeType == node.TEXT_NODE:
@@ -436,43 +579,73 @@ class ImgOccNoteGenerator(object):
     def _saveMaskAndReturnNote(self, omask_path, qmask, amask,
                                img, note_id, nid=None):
         """Write actual note for given qmask and amask"""
-        fields = self.fields
-        model = self.mconfig['model']
-        mflds = self.mconfig['mflds']
+        fields = dict(self.fields) # mask fields must not leak into the next note
         ioflds = self.mconfig['ioflds']
         fields[ioflds['im']] = img
         if omask_path:
-            # Occlusions updated
-            qmask_path = self._saveMask(qmask, note_id, "Q")
-            amask_path = self._saveMask(amask, note_id, "A")
-            fields[ioflds['qm']] = fname2img(qmask_path)
-            fields[ioflds['am']] = fname2img(amask_path)
+            # Occlusions updated, masks that weren't made are cleared
+            fields[ioflds['qm']] = self._saveMaskField(qmask, note_id, "Q")
+            fields[ioflds['am']] = self._saveMaskField(amask, note_id, "A")
             fields[ioflds['om']] = fname2img(omask_path)
             fields[ioflds['id']] = note_id
 
-        model['did'] = self.did
-        if nid:
-            note = mw.col.getNote(nid)
-        else:
-            note = Note(mw.col, model)
-
-        logging.debug(f'mflds1: {mflds}')
-        logging.debug(f'fields1: {fields}')
-        # add fields to note
-        note.tags = self.tags
-        logging.debug(f'note1: {note}')
-        for i in mflds:
-            fname = i["name"]
-            if fname in fields:
-                # only update fields that have been modified
-                note[fname] = fields[fname]
+        self._writeNote(fields, nid)
 
-        if nid:
-            note.flush()
-            logging.debug("!noteflush %s", note)
-        else:
-            mw.col.addNote(note)
-            logging.debug("!notecreate %s", note)
+    def _saveFieldsNote(self, omask_path, img, note_id, nid=None):
+        """
+        Write note whose masks are up to date, pointing it at the original
+        mask of the session unless omask_path is None
+        """
+        fields = dict(self.fields)
+        ioflds = self.mconfig['ioflds']
+        fields[ioflds['im']] = img
+        if omask_path:
+            # content addressed, the name changes with every edit
+            fields[ioflds['om']] = fname2img(omask_path)
+            fields[ioflds['id']] = note_id
+        self._writeNote(fields, nid)
+
+    def _saveMaskField(self, mask, note_id, mtype):
+        """Field content of mask, written to the media collection unless None"""
+        if mask is None:
+            return ''
+        return fname2img(self._saveMask(mask, note_id, mtype))
+
+    def _saveImgField(self, img_obj, note_id, mtype):
+        """Field content of img_obj, written to the media collection unless None"""
+        if img_obj is None:
+            return ''
+        return fname2img(self._save_img(img_obj, note_id, mtype))
+
+    def _writeNote(self, fields, nid=None):
+        """Create note or update note nid with given fields"""
+        if self._batch is not None:
+            self._batch.add(fields, nid)
+            return
+        batch = NoteBatch(self.mconfig['model'], self.mconfig['mflds'],
+                          self.did, self.tags)
+        batch.add(fields, nid)
+        batch.commit()
+
+    def _updateNoteType(self):
+        """Make the note type CSS and templates follow the preferences"""
+        if self.note_tp in MASK_COLOUR_TYPES:
+            update_mask_colours(mw.col, self.mconfig['model'], self.sconf)
+
+    def _startBatch(self):
+        """Collect notes written from now on until _commitBatch"""
+        self._batch = NoteBatch(self.mconfig['model'], self.mconfig['mflds'],
+                                self.did, self.tags)
+
+    def _commitBatch(self):
+        """Write all collected notes to the collection at once and index them"""
+        (batch, self._batch) = (self._batch, None)
+        self._media.sync() # notes must not refer to media lost in a crash
+        logging.debug(self._media.report())
+        logging.debug("committing %s notes", len(batch))
+        nids = batch.commit()
+        sessionIndex().store((nid, note_id, mod) for nid, mod, note_id
+                             in readNoteIds(nids, self.mconfig['ioflds']['id']))
 
 
 # Different generator subclasses for different occlusion types:
@@ -514,15 +687,12 @@ class IoGenOA(ImgOccNoteGenerator):
             mask_node = mlayer_node.childNodes[i]
             if i == mask_node_index and side == "Q":
                 self._setQuestionAttribs(mask_node)
-                mask_node.setAttribute("class", "qshape")
+                if not mask_node.hasAttribute("class"): # text nodes
+                    mask_node.setAttribute("class", "qshape")
             else:
                 mlayer_node.removeChild(mask_node)
 
 
-import xml.etree.ElementTree as ET
-import re
-from PIL import Image
-
 class IoGenSI(ImgOccNoteGenerator):
     """
     class for processing short image
@@ -530,6 +700,7 @@ class IoGenSI(ImgOccNoteGenerator):
     Consumes less storage
     """
     occl_tp = "si"
+    mask_builder = SIMaskBuilder
 
     def __init__(self, ed, svg, image_path, opref, tags, fields, did, note_tp):
         self.note_tp = 'si'
@@ -542,6 +713,11 @@ class IoGenSI(ImgOccNoteGenerator):
         self.hider_col = '#FFFFFF'
         self.regular_inverse_fill = '#2b2c2e'
         self.reverse_inverse_fill = '#414c61'
+        self._builder = None # parsed self.new_svg, shared by all cards
+        self._writer = None # write-behind queue for card media, see _startWriter
+        self._card_writes = [] # queued media writes
+        self._queued = set() # media paths written by _card_writes
+        self._encoder = None # encoder of question/answer images, see _imgEncoder
 
     def _showUpdateTooltip(self, del_count, new_count):
         upd_count = max(0, len(self.mnode_ids) - del_count - new_count)
@@ -744,9 +920,9 @@ class IoGenSI(ImgOccNoteGenerator):
         self.occl_id = '%s-%s' % (self.uniq_id, self.occl_tp)
         omask_path = None
 
-        self._findAllNotes()
         (svg_node, mlayer_node, rlayer_node, blayer_node) = self._getMnodesAndSetIds(True) ###@ edt oneln
-        if not (self.mnode_ids or self.rnode_ids) : ###@ add oneitm
+        self._findAllNotes()
+        if not next(self._iterCards(), None): ###@ add oneitm
             tooltip("No shapes left. You can't delete all cards.<br>\
                 Are you sure you set your masks correctly?")
             return False
@@ -759,96 +935,101 @@ class IoGenSI(ImgOccNoteGenerator):
             (del_count, new_count) = ret
 
         svg_node = self.strip_attr(svg_node)
-        self.new_svg = self.remove_namespace(ET.tostring(svg_node).decode('utf-8'))  # write changes to svg
+        svg_node.attrib.pop(GEN_SETTINGS_ATTRIB, None) # recorded in the original mask only
+        self.new_svg = svgToString(svg_node)  # write changes to svg
+        omask_svg = withGenSettings(self.new_svg, self._genSettings())
         old_svg = self._getOriginalSvg()  # load original svg
         logging.debug(f'self.new_svg {self.new_svg}')
         logging.debug(f'old_svg {old_svg}')
-        if self.new_svg != old_svg:
-            # updated masks
-            omask_path = self._saveMask(self.new_svg, self.occl_id, "O")
-            # qmasks = self._generateMaskSVGsFor("Q")
-            # amasks = self._generateMaskSVGsFor("A")
-            reg_qmasks = self._generateMaskSVGsForRegular("Q")
-            reg_amasks = self._generateMaskSVGsForRegular("A")
-            rev_qmasks = self._generateMaskSVGsForReverse("Q")
-            rev_amasks = self._generateMaskSVGsForReverse("A")
+        if (svgFingerprint(omask_svg) != svgFingerprint(old_svg) or
+                self.image_path != self.opref["image"] or
+                self.occl_tp != self.opref["occl_tp"]):
+            # updated masks, settings, image or occlusion type
+            omask_path = self._saveMask(omask_svg, self.occl_id, "O")
             state = "reset"
-            logging.debug(f'reg_qmasks {reg_qmasks}')
-            logging.debug(f'reg_amasks {reg_amasks}')
-            logging.debug(f'rev_qmasks {rev_qmasks}')
-            logging.debug(f'rev_amasks {rev_amasks}')
 
         image_path = mw.col.media.addFile(self.image_path)
         img = fname2img(image_path)
 
-        # for regular q
-        logging.debug("mnode_indexes %s", self.mnode_ids.keys())
-        for nr, idx in enumerate(self.mnode_ids.keys()):
-            logging.debug("========= regular q ============")
-            logging.debug("nr %s", nr)
-            logging.debug("idx %s", idx)
-            note_id = self.mnode_ids[idx]
-            q_nid = mw.col.findNotes(f'"{self.mconfig["ioflds"]["id"]}:{note_id}"')
+        self._updateNoteType()
+        self._startBatch()
+        self._startWriter()
+        try:
+            self._updateCardNotes(omask_path, img)
+        finally:
+            self._stopWriter()
+        self._commitBatch() # media is on disk now
+        self._showUpdateTooltip(del_count, new_count)
+        return state
+
+    def _updateCardNotes(self, omask_path, img):
+        """
+        Write notes of an edited occlusion session, masks are only rebuilt
+        for cards whose occlusions changed
+        """
+        stale = self._staleNoteIds() if omask_path else set()
+        rebuild = [] # (card, note_id, nid) of notes with outdated masks
+        for card, note_id in self._iterCards():
+            logging.debug("========= %s q ============", card[0])
+            logging.debug("card %s", card)
             logging.debug("note_id %s", note_id)
             logging.debug("self.nids %s", self.nids)
-            nid = self.nids[note_id]
+            nid = self.nids.get(note_id)
             logging.debug("nid %s", nid)
-            if omask_path:
-                if not q_nid:
-                    self._saveMaskAndReturnNote(omask_path, reg_qmasks[nr], reg_amasks[nr], img, note_id)
-            else:
-                self._saveMaskAndReturnNote(None, None, None,
-                                            img, note_id, nid)
-        # for reverse q
-        logging.debug("rnode_ids %s", self.rnode_ids)
-        nr = 0
-        for qset_idx in self.rnode_ids.keys():
-            for q_idx in self.rnode_ids[qset_idx].keys():
-                logging.debug("========= rev q ============")
-                logging.debug("nr %s", nr)
-                logging.debug("qset_idx %s", qset_idx)
-                logging.debug("q_idx %s", q_idx)
-                note_id = self.rnode_ids[qset_idx][q_idx]
-                q_nid = mw.col.findNotes(f'"{self.mconfig["ioflds"]["id"]}:{note_id}"')
-                logging.debug("note_id %s", note_id)
-                logging.debug("self.nids %s", self.nids)
-                nid = self.nids[note_id]
-                logging.debug("nid %s", nid)
-                if omask_path:
-                    if not q_nid:
-                        self._saveMaskAndReturnNote(omask_path, rev_qmasks[nr], rev_amasks[nr], img, note_id)
-                else:
-                    self._saveMaskAndReturnNote(None, None, None,
-                                                img, note_id, nid)
-                nr+=1
-        self._showUpdateTooltip(del_count, new_count)
-        return state
+            if omask_path and (stale is None or note_id in stale or not nid):
+                rebuild.append((card, note_id, nid))
+            else: # masks are up to date, the original mask may have moved
+                self._saveCardNote(omask_path, None, img, note_id, nid)
+        logging.debug(f'rebuilding {len(rebuild)} cards')
+        all_masks = self._iterCardsMasks([card for card, _, _ in rebuild])
+        for (card, note_id, nid), card_masks in zip(rebuild, all_masks):
+            logging.debug(f'card {card} card_masks {card_masks}')
+            self._saveCardNote(omask_path, card_masks, img, note_id, nid)
+
+    def _staleNoteIds(self):
+        """
+        Return note ids of cards whose masks are outdated after the edit,
+        None if all of them are
+        """
+        if (self.occl_tp != self.opref["occl_tp"] or
+                self.image_path != self.opref["image"]):
+            return None
+        try:
+            with open(self.opref["omask"], encoding='utf8') as omask_file:
+                old_signatures = cardSignatures(omask_file.read())
+        except (OSError, ET.ParseError) as e:
+            logging.warning(f'original mask unreadable, rebuilding all cards: {e}')
+            return None
+        return {note_id for note_id, signature
+                in cardSignatures(self.new_svg, self._genSettings()).items()
+                if old_signatures.get(note_id) != signature}
+
+    def _genSettings(self):
+        """
+        Key of the settings that change the masks and images of cards,
+        empty for the defaults all sessions were built with before
+        """
+        encoder = self._imgEncoder()
+        settings = {}
+        if self.sconf.get('sparse_masks', default_conf_syncd['sparse_masks']):
+            settings['sparse_masks'] = True
+        if self._imgMode() != 'full':
+            settings['img_mode'] = self._imgMode()
+        if encoder.format != 'png': # other settings don't change PNGs
+            settings['img_encoder'] = (encoder.format, encoder.quality,
+                                       encoder.effort, encoder.budget)
+        if not settings:
+            return ''
+        return hashlib.sha1(repr(sorted(settings.items())).encode('utf8')).hexdigest()[:16]
 
-    def inverse_wrapper(self, wrapper_elm, root_elm, fill_col): # wrapper should be shape or path, not g
-        if wrapper_elm.tag == self._ns('rect'):
-            r_height = float(root_elm.get('height'))
-            r_width = float(root_elm.get('width'))
-
-            w_x = float(wrapper_elm.get('x'))
-            w_y = float(wrapper_elm.get('y'))
-            w_height = float(wrapper_elm.get('height'))
-            w_width = float(wrapper_elm.get('width'))
-        # demo  structure
-        #   <rect x="100" y="100" width="300" height="100" style="fill:rgb(0,0,255);stroke-width:3;stroke:rgb(0,0,0)" />
-        #   <path d="m0,0 800,0 l0,800## l-800,0## l0,-700## l95,0 l0,105 l310,0## l0,-110 l-310,0 l0,5 l-95,0 z" stroke="green" stroke-width="3"
-        #   fill="none" />
-
-            path_d = f"m0,0 l{r_width},0 l0,{r_height} l{-r_width},0 l0,{-(r_height-w_y)} l{w_x-5},0 l0,{w_height+5} l{w_width+10},0 l0,{-(w_height+10)} l{-(w_width+10)},0 l0,5 l{-(w_x-5)},0 z"
-            inversed_elm = ET.Element('path', attrib={'id': 'inversed_wrapper', 'd': path_d, 'fill': fill_col})
-            return inversed_elm
-    
     def _setQuestionAttribs(self, node):
         """Set question node color and class"""
         if (node.nodeType == node.ELEMENT_NODE and node.tagName != "text"):
             # set question class
             node.setAttribute("class", "qshape")
             if node.hasAttribute("fill"):
-                # set question color
+                # set question color, the class lets the card CSS override it
+                node.setAttribute("class", "qshape " + fillClass('qfill'))
                 node.setAttribute("fill", self.qfill)
             list(map(self._setQuestionAttribs, node.childNodes))
 
@@ -859,226 +1040,148 @@ class IoGenSI(ImgOccNoteGenerator):
         elif side == "A":
             mlayer_node.removeChild(mask_node)
 
-    def _generateMaskSVGsForRegular(self, side):
-        """Generate a mask for each regular questions"""
-        masks = []
-        
-        if side == 'Q':
-            for q_elm_idx in self.mnode_ids.keys(): # elm might be rect/g/path/shape
-                svg_node = ET.fromstring(self.new_svg)
-                layer_nodes = self._layerNodesFrom(svg_node)
-                mlayer_node = layer_nodes[-1]  # treat topmost layer as masks layer
-                
-                for elm in svg_node.iter(): # hide all shapes from root
-                    elm.set('opacity', '0')
-
-                q_elm = mlayer_node[q_elm_idx]
-                q_elm.set('class', 'qshape')
-
-                if q_elm.get('fill'): # elms except g
-                    q_elm.set('fill', self.qfill)
-                else: # elms only g
-                    for q_shape in q_elm.findall('*'):
-                        if q_shape.get('fill') != 'none': # these are q shapes 
-                            q_shape.set('class', 'qshape')
-                            q_shape.set('fill', self.qfill)
-                        else: # these are ommitting shapes, shape fill is set to none
-                            q_shape.set('fill', self.hider_col)
-                            q_shape.set('class', 'hider')
-
-                # preserved elms -> root, layers, titles, current q elms
-                preserved_shapes_all = [svg_node, svg_node[0], svg_node[0][0], svg_node[1], 
-                                    svg_node[1][0], svg_node[2], svg_node[2][0]]
-                if q_elm.tag == self._ns('rect'): # this is a simple single q shape
-                    preserved_shapes_ques = [q_elm]
-                elif q_elm.tag == self._ns('g'): # this is a g containing q shapes and hiders
-                    preserved_shapes_all += [q_elm]
-                    preserved_shapes_ques = svg_node.find('.//*[@class="qshape"]').findall('*') # preserve shapes with parent having class=qshape
-                preserved_shapes_all += preserved_shapes_ques
-                
-                q_wrapper = mlayer_node[q_elm_idx + 1]
-
-                for elm in svg_node.iter():
-                    if elm in preserved_shapes_all: # unhide current q shapes and default shapes
-                        del elm.attrib['opacity']
-
-                for elm in svg_node.iter(): # set heavy fill to current q shapes and hiders
-                    if elm in preserved_shapes_ques:
-                        elm.set('opacity', '1')
-
-                inversed_wrapper = self.inverse_wrapper(q_wrapper, svg_node, self.regular_inverse_fill)
-                svg_node.append(inversed_wrapper)
-                xml = self.remove_namespace(ET.tostring(svg_node).decode('utf-8'))
-                masks.append(xml)
-
-        elif side == 'A':
-            for q_elm_idx in self.mnode_ids.keys(): # elm might be rect/g/path/shape
-                svg_node = ET.fromstring(self.new_svg)
-                layer_nodes = self._layerNodesFrom(svg_node)
-                mlayer_node = layer_nodes[-1]  # treat topmost layer as masks layer
-                
-                for elm in svg_node.iter(): # hide all shapes from root
-                    elm.set('opacity', '0')
-
-                q_elm = mlayer_node[q_elm_idx]
-                q_elm.set('class', 'ashape')
-
-                if q_elm.get('fill'): # elms except g
-                    q_elm.set('fill', self.afill)
-                else: # elms only g
-                    for q_shape in q_elm.findall('*'):
-                        if q_shape.get('fill') != 'none': # these are q shapes 
-                            q_shape.set('class', 'ashape')
-                            q_shape.set('fill', self.afill)
-                        else: # these are ommitting shapes, shape fill is set to none
-                            q_shape.set('fill', self.hider_col)
-                            q_shape.set('class', 'hider')
-
-                # preserved elms -> root, layers, titles, current q elms
-                preserved_shapes_all = [svg_node, svg_node[0], svg_node[0][0], svg_node[1], 
-                                    svg_node[1][0], svg_node[2], svg_node[2][0]]
-                if q_elm.tag == self._ns('rect'): # this is a simple single q shape
-                    preserved_shapes_ques = [q_elm]
-                elif q_elm.tag == self._ns('g'): # this is a g containing q shapes and hiders
-                    preserved_shapes_all += [q_elm]
-                    preserved_shapes_ques = svg_node.find('.//*[@class="ashape"]').findall('*') # preserve shapes with parent having class=qshape
-                preserved_shapes_all += preserved_shapes_ques
-                
-                q_wrapper = mlayer_node[q_elm_idx + 1]
-
-                for elm in svg_node.iter():
-                    if elm in preserved_shapes_all: # unhide current q shapes and default shapes
-                        del elm.attrib['opacity']
-
-                for elm in svg_node.iter(): # set slight fill to q shapes and heavy fill to hiders
-                    if elm in preserved_shapes_ques:
-                        if elm.get('class') == 'hider':
-                            elm.set('opacity', '1')
-                        else:
-                            elm.set('opacity', '0.3')
+    def _getMaskBuilder(self):
+        """Return a mask builder that has parsed the current self.new_svg"""
+        if self._builder is None or self._builder_svg != self.new_svg:
+            self._builder = self._maskBuilderCls()(self.new_svg, self._maskFills(),
+                                                   self.image_path)
+            self._builder_svg = self.new_svg
+        return self._builder
 
-                q_wrapper = mlayer_node[q_elm_idx + 1]
-                inversed_wrapper = self.inverse_wrapper(q_wrapper, svg_node, self.regular_inverse_fill)
-                svg_node.append(inversed_wrapper)
-                xml = self.remove_namespace(ET.tostring(svg_node).decode('utf-8'))
-                masks.append(xml)
-        return masks
-                
-    def _generateMaskSVGsForReverse(self, side):
-        """Generate a mask for each reverse question """
-        masks = []
-
-        if side == 'Q':
-            for q_g_idx in self.rnode_ids.keys(): # g is question set
-                for q_elm_idx in self.rnode_ids[q_g_idx]:
-                    svg_node = ET.fromstring(self.new_svg)
-                    layer_nodes = self._layerNodesFrom(svg_node)
-                    rlayer_node = layer_nodes[-2]  # treat 2nd topmost layer as reverse masks layer
-
-                    for elm in svg_node.iter(): # hide all shapes from root
-                        elm.set('opacity', '0')
-
-                    qset_elm = rlayer_node[q_g_idx]
-                    qset_elm.set('class', 'qset')
-                    q_elm = qset_elm[q_elm_idx] # this is a single question -> rect/g
-                    q_elm.set('class', 'qshape')
-                    if q_elm.get('fill'): # elms except g
-                        q_elm.set('fill', self.rev_qfill)
-                    else: # elms only g
-                        for q_shape in q_elm.findall('*'):
-                            q_shape.set('class', 'qshape')
-                            q_shape.set('fill', self.rev_qfill)
-
-                    # preserved elms -> root, layers, titles, current q elms
-                    preserved_shapes_all = [svg_node, svg_node[0], svg_node[0][0], svg_node[1], 
-                                            svg_node[1][0], svg_node[2], svg_node[2][0], qset_elm]
-                    if q_elm.tag == self._ns('rect'): # this is a simple single q shape
-                        preserved_shapes_ques = [q_elm]
-                    elif q_elm.tag == self._ns('g'): # this is a g containing attached q shape
-                        preserved_shapes_all += [q_elm]
-                        preserved_shapes_ques = q_elm.findall('*')
-                    preserved_shapes_ques += [i for i in  qset_elm.findall('*') if i.get('fill') == 'none']
-                    preserved_shapes_all += preserved_shapes_ques
-
-                    q_wrapper = rlayer_node[q_g_idx + 1]
-
-                    for elm in svg_node.iter():
-                        if elm in preserved_shapes_all: # unhide current q shapes and default shapes
-                            del elm.attrib['opacity']
-
-                    for elm in svg_node.iter(): # set heavy fill to current q shapes and hiders
-                        if elm in preserved_shapes_ques:
-                            if not elm.get('fill') == 'none':
-                                elm.set('opacity', '1')
-                            else:
-                                elm.set('opacity', '1')
-                                elm.set('fill', self.hider_col)
-                                elm.set('class', 'hider')
-                            
-                    inversed_wrapper = self.inverse_wrapper(q_wrapper, svg_node, self.regular_inverse_fill)
-                    svg_node.append(inversed_wrapper)
-                    xml = self.remove_namespace(ET.tostring(svg_node).decode('utf-8'))
-                    masks.append(xml)
-
-        elif side == 'A':
-            for q_g_idx in self.rnode_ids.keys(): # g is question set
-                for q_elm_idx in self.rnode_ids[q_g_idx]:
-                    svg_node = ET.fromstring(self.new_svg)
-                    layer_nodes = self._layerNodesFrom(svg_node)
-                    rlayer_node = layer_nodes[-2]  # treat 2nd topmost layer as reverse masks layer
-
-                    for elm in svg_node.iter(): # hide all shapes from root
-                        elm.set('opacity', '0')
-
-                    qset_elm = rlayer_node[q_g_idx]
-                    qset_elm.set('class', 'qset')
-                    q_elm = qset_elm[q_elm_idx] # this is a single question -> rect/g
-                    q_elm.set('class', 'qshape')
-                    if q_elm.get('fill'): # elms except g
-                        q_elm.set('fill', self.rev_afill)
-                    else: # elms only g
-                        for q_shape in q_elm.findall('*'):
-                            q_shape.set('class', 'qshape')
-                            q_shape.set('fill', self.rev_afill)
-
-                    # preserved elms -> root, layers, titles, current q elms
-                    preserved_shapes_all = [svg_node, svg_node[0], svg_node[0][0], svg_node[1], 
-                                        svg_node[1][0], svg_node[2], svg_node[2][0], qset_elm]
-
-                    if q_elm.tag == self._ns('rect'): # this is a simple single q shape
-                        preserved_shapes_ques = [q_elm]
-                    elif q_elm.tag == self._ns('g'): # this is a g containing attached q shape
-                        preserved_shapes_all += [q_elm]
-                        preserved_shapes_ques = q_elm.findall('*')
-                    preserved_shapes_ques += [i for i in  qset_elm.findall('*') if i.get('fill') == 'none']
-                    preserved_shapes_all += preserved_shapes_ques
-
-                    q_wrapper = rlayer_node[q_g_idx + 1]
-
-                    for elm in svg_node.iter():
-                        if elm in preserved_shapes_all: # unhide current q shapes and default shapes
-                            del elm.attrib['opacity']
-
-                    for elm in svg_node.iter(): # set heavy fill to current q shapes and hiders
-                        if elm in preserved_shapes_ques:
-                            if not elm.get('fill') == 'none':
-                                elm.set('opacity', '0.3')
-                            else:
-                                elm.set('opacity', '1')
-                                elm.set('fill', self.hider_col)
-                                elm.set('class', 'hider')
-
-                    inversed_wrapper = self.inverse_wrapper(q_wrapper, svg_node, self.reverse_inverse_fill)
-                    svg_node.append(inversed_wrapper)
-                    xml = self.remove_namespace(ET.tostring(svg_node).decode('utf-8'))
-                    masks.append(xml)  
-        return masks
+    def _maskBuilderCls(self):
+        """
+        mask_builder with the configured emission mode, skipping the
+        artifacts the card templates don't show
+        """
+        sparse = self.sconf.get('sparse_masks', default_conf_syncd['sparse_masks'])
+        unused = [output for output, fld_id in (('qmask', 'qm'), ('amask', 'am'),
+                                                ('q_img', 'q_img'), ('a_img', 'a_img'))
+                  if not self._renders(fld_id)]
+        return functools.partial(self.mask_builder, sparse=sparse, unused=unused,
+                                 img_mode=self._imgMode())
+
+    def _maskFills(self):
+        return {'qfill': self.qfill, 'afill': self.afill,
+                'rev_qfill': self.rev_qfill, 'rev_afill': self.rev_afill,
+                'hider_col': self.hider_col, 'hider_fill': self.hider_fill,
+                'blankq_fill': self.blankq_fill,
+                'regular_inverse_fill': self.regular_inverse_fill,
+                'reverse_inverse_fill': self.reverse_inverse_fill}
+
+    def _iterCards(self):
+        """Yield (card, note_id) for every question, in note order"""
+        for idx, note_id in self.mnode_ids.items():
+            yield (('regular', idx), note_id)
+        for qset_idx in self.rnode_ids.keys():
+            for q_idx, note_id in self.rnode_ids[qset_idx].items():
+                yield (('reverse', (qset_idx, q_idx)), note_id)
+        if 'blank' in self.mask_builder.kinds:
+            for idx, note_id in self.bnode_ids.items():
+                yield (('blank', idx), note_id)
+
+    def _cardNoteIds(self):
+        return [note_id for _, note_id in self._iterCards()]
+
+    def _buildCardMasks(self, card):
+        """Build question and answer side of a card in a single pass"""
+        return self._getMaskBuilder().build(card)
+
+    def _iterCardsMasks(self, cards):
+        """
+        Yield masks of cards in order, one at a time, in worker threads if
+        enabled. Nothing is built ahead of the consumer beyond a small window.
+        """
+        built = 0
+        workers = self._genWorkers()
+        if workers > 1 and len(cards) >= PARALLEL_MIN_CARDS:
+            for card_masks in iterCardsParallel(self._maskBuilderCls(), self.new_svg,
+                                                self._maskFills(), self.image_path,
+                                                cards, workers,
+                                                encoder=self._imgEncoder()):
+                yield card_masks
+                built += 1
+        for card in cards[built:]: # serially, or the rest of a failed pool
+            yield self._buildCardMasks(card)
+
+    def _genWorkers(self):
+        """Number of worker threads for mask generation, 0 if disabled"""
+        if not self.lconf.get('parallel_gen', default_conf_local['parallel_gen']):
+            return 0
+        return self.lconf.get('gen_workers') or os.cpu_count() or 1
+
+    def _saveCardNote(self, omask_path, card_masks, img, note_id, nid=None):
+        """Write note of a card, card_masks is None if occlusions are unchanged"""
+        if card_masks is None:
+            return self._saveFieldsNote(omask_path, img, note_id, nid)
+        return self._saveMaskAndReturnNote(omask_path, card_masks.qmask,
+                                           card_masks.amask, img, note_id, nid)
+
+    def _startWriter(self):
+        """Write card media on background threads until _stopWriter"""
+        self._writer = WriteBehindQueue(self._media)
+        self._card_writes = []
+        self._queued = set() # media paths written by _card_writes
+
+    def _stopWriter(self):
+        """Wait for all queued media, raises if writing any of it failed"""
+        try:
+            self._writer.close()
+            for write in self._card_writes:
+                write.result()
+        finally:
+            self._writer = None
+            self._card_writes = []
+            self._queued = set()
+
+    def _saveMask(self, mask, note_id, mtype):
+        if self._writer is None:
+            return ImgOccNoteGenerator._saveMask(self, mask, note_id, mtype)
+        logging.debug("!queueing %s, %s", note_id, mtype)
+        # media collection is the working directory:
+        mask_path = contentName(mask, 'svg')
+        self._queueMedia(mask_path, mask)
+        return mask_path
+
+    def _save_img(self, img_obj, note_id, mtype):
+        encoder = self._imgEncoder()
+        if self._writer is None or (encoder.ext is None and
+                                    not isinstance(img_obj, EncodedImage)):
+            # auto picks the format, and so the file name, while encoding
+            return ImgOccNoteGenerator._save_img(self, img_obj, note_id, mtype)
+        logging.debug("!queueing %s, %s", note_id, mtype)
+        # media collection is the working directory:
+        img_path = contentName(img_obj, encoder=encoder)
+        self._queueMedia(img_path, img_obj, encoder)
+        return img_path
+
+    def _queueMedia(self, path, data, encoder=png_encoder):
+        """Queue data to be written to path unless it is there or queued already"""
+        if path in self._queued or self._media.exists(path):
+            return
+        self._queued.add(path)
+        self._card_writes.append(self._writer.submit(path, data, encoder))
+
+    def _imgMode(self):
+        """How LI/SLI cards show their images, one of masks.IMG_MODES"""
+        model_map = self.sconf['io_models_map'].get(self.note_tp, {})
+        img_mode = model_map.get('img_mode', 'full')
+        if img_mode not in IMG_MODES:
+            logging.warning(f'unknown img_mode {img_mode!r}, using full')
+            return 'full'
+        return img_mode
+
+    def _imgEncoder(self):
+        if self._encoder is None:
+            model_map = self.sconf['io_models_map'].get(self.note_tp, {})
+            self._encoder = ImageEncoder.fromConfig(model_map.get('img_encoder'))
+        return self._encoder
+
+    def _showAddTooltip(self, counts):
+        ttip = f"{sum(counts.values())} cards <b>added</b>"
+        for kind in self.mask_builder.kinds:
+            ttip += f"<br>{kind}: {counts.get(kind, 0)}"
+        tooltip(ttip, parent=None)
 
-    def remove_namespace(self, xml_str):
-        str_parts = re.split("ns0:|:ns0",xml_str)
-        filtered_xml_str = ''.join(str_parts)
-        return filtered_xml_str
-        
     def _ns(self, tagname):
         ns = '{http://www.w3.org/2000/svg}'
         return ns+tagname
@@ -1188,33 +1291,35 @@ class IoGenSI(ImgOccNoteGenerator):
         #         Please create one more shape to be counted as question wrapper.")
         #     return False
         (svg_node, layer_node, rlayer_node, blayer_node) = self._getMnodesAndSetIds() ### edt oneln
-        if not (self.mnode_ids or self.rnode_ids):
+        cards = list(self._iterCards())
+        if not cards:
             tooltip("No cards to generate.<br>\
                 Are you sure you set your masks correctly?")
             return False
 
         svg_node = self.strip_attr(svg_node)
-        self.new_svg = self.remove_namespace(ET.tostring(svg_node).decode('utf-8')) # write changes to svg ###@ edt oneitm
-        omask_path = self._saveMask(self.new_svg, self.occl_id, "O")
-        reg_qmasks = self._generateMaskSVGsForRegular("Q")
-        reg_amasks = self._generateMaskSVGsForRegular("A")
-        rev_qmasks = self._generateMaskSVGsForReverse("Q")
-        rev_amasks = self._generateMaskSVGsForReverse("A")
+        svg_node.attrib.pop(GEN_SETTINGS_ATTRIB, None) # recorded in the original mask only
+        self.new_svg = svgToString(svg_node) # write changes to svg ###@ edt oneitm
+        omask_path = self._saveMask(withGenSettings(self.new_svg, self._genSettings()),
+                                    self.occl_id, "O")
         image_path = mw.col.media.addFile(self.image_path)
         img = fname2img(image_path)
 
         mw.checkpoint("Adding Image Occlusion Cards")
-        for nr, idx in enumerate(self.mnode_ids.keys()):
-            note_id = self.mnode_ids[idx]
-            self._saveMaskAndReturnNote(omask_path, reg_qmasks[nr], reg_amasks[nr], img, note_id)
-
-        nr = 0                          
-        for g_idx in self.rnode_ids.keys():
-            for rnode_idx in self.rnode_ids[g_idx]:
-                note_id = self.rnode_ids[g_idx][rnode_idx]
-                self._saveMaskAndReturnNote(omask_path, rev_qmasks[nr], rev_amasks[nr], img, note_id)
-                nr += 1
-        tooltip(f"{len(reg_qmasks)+len(rev_qmasks)} cards <b>added</b><br>regular: {len(reg_qmasks)}<br>reverse: {len(rev_qmasks)}", parent=None)
+        counts = {}
+        all_masks = self._iterCardsMasks([card for card, _ in cards])
+        self._updateNoteType()
+        self._startBatch()
+        self._startWriter()
+        try:
+            for (card, note_id), card_masks in zip(cards, all_masks):
+                logging.debug(f'card {card} card_masks {card_masks}')
+                self._saveCardNote(omask_path, card_masks, img, note_id)
+                counts[card[0]] = counts.get(card[0], 0) + 1
+        finally:
+            self._stopWriter()
+        self._commitBatch() # media is on disk now
+        self._showAddTooltip(counts)
         return state
 
 class IoGenLI(IoGenSI):
@@ -1223,525 +1328,84 @@ class IoGenLI(IoGenSI):
     Consumes high storage
     """
     occl_tp = "li"
+    mask_builder = LIMaskBuilder
+    # image of a compact card with the overlay of its side on top
+    compact_html = '<div class="io-compact" style="position:relative;display:inline-block">%s%s</div>'
+    # region of the source image shown by a clipped card, see template.clip_imgs_css.
+    # The spacer gives the region its aspect ratio, the image is scaled and
+    # moved relative to it in percent so that the card can be resized.
+    clip_html = ('<div class="io-clip" style="max-width:%(width)dpx">'
+                 '<div style="padding-bottom:%(ratio)s%%"></div>'
+                 '<img src="%(src)s" style="left:%(left)s%%;top:%(top)s%%;width:%(scale)s%%" />'
+                 '%(svg)s</div>')
 
     def __init__(self, ed, svg, image_path, opref, tags, fields, did, note_tp):
         self.note_tp = 'li'
         IoGenSI.__init__(self, ed, svg, image_path,
                                      opref, tags, fields, did, note_tp)
+
+    def _updateNoteType(self):
+        IoGenSI._updateNoteType(self)
+        if self._imgMode() == 'clip':
+            update_clip_imgs(mw.col, self.mconfig['model'])
                                      
 
     def _saveMaskAndReturnNote(self, omask_path, qmask, amask, img_obj_q, img_obj_a,
-                               img, note_id, nid=None):
-        """Write actual note for given qmask and amask"""
-        fields = self.fields
-        model = self.mconfig['model']
-        mflds = self.mconfig['mflds']
+                               img, note_id, nid=None, overlay=None):
+        """
+        Write actual note for given qmask and amask. Compact cards have
+        a single image in img_obj_q and an overlay SVG per side, clipped
+        cards show a region of img under their overlays.
+        """
+        fields = dict(self.fields) # mask fields must not leak into the next note
         ioflds = self.mconfig['ioflds']
         fields[ioflds['im']] = img
+        if omask_path and overlay is not None and overlay.clip is not None:
+            # Occlusions updated, nothing but the source image is stored
+            for fld_id, overlay_svg in zip(('q_img', 'a_img'), overlay[:2]):
+                fields[ioflds[fld_id]] = self._clipField(img, overlay.clip, overlay_svg)
+        elif omask_path and overlay is not None and img_obj_q is None:
+            # Occlusions updated, the overlay is all there is to show
+            fields[ioflds['q_img']] = overlay.q_svg
+            fields[ioflds['a_img']] = overlay.a_svg
+        elif omask_path and overlay is not None:
+            # Occlusions updated, both sides show the same image
+            img_field = self._saveImgField(img_obj_q, note_id, 'Q')
+            for fld_id, overlay_svg in zip(('q_img', 'a_img'), overlay[:2]):
+                fields[ioflds[fld_id]] = self.compact_html % (img_field, overlay_svg) \
+                                         if img_field else ''
+        elif omask_path:
+            # Occlusions updated, artifacts that weren't built are cleared
+            fields[ioflds['q_img']] = self._saveImgField(img_obj_q, note_id, 'Q')
+            fields[ioflds['a_img']] = self._saveImgField(img_obj_a, note_id, 'A')
         if omask_path:
-            # Occlusions updated
-            q_img_path = self._save_img(img_obj_q, note_id, 'Q')
-            a_img_path = self._save_img(img_obj_a, note_id, 'A')
-            fields[ioflds['q_img']] = fname2img(q_img_path)
-            fields[ioflds['a_img']] = fname2img(a_img_path)
-            qmask_path = self._saveMask(qmask, note_id, "Q")
-            amask_path = self._saveMask(amask, note_id, "A")
-            fields[ioflds['qm']] = fname2img(qmask_path)
-            fields[ioflds['am']] = fname2img(amask_path)
+            fields[ioflds['qm']] = self._saveMaskField(qmask, note_id, "Q")
+            fields[ioflds['am']] = self._saveMaskField(amask, note_id, "A")
             fields[ioflds['om']] = fname2img(omask_path)
             fields[ioflds['id']] = note_id
 
-        model['did'] = self.did
-        if nid:
-            note = mw.col.getNote(nid)
-        else:
-            note = Note(mw.col, model)
-
-        logging.debug(f'mflds1: {mflds}')
-        logging.debug(f'fields1: {fields}')
-        # add fields to note
-        note.tags = self.tags
-        logging.debug(f'note1: {note}')
-        for i in mflds:
-            fname = i["name"]
-            if fname in fields:
-                # only update fields that have been modified
-                note[fname] = fields[fname]
-
-        if nid:
-            note.flush()
-            logging.debug("!noteflush %s", note)
-        else:
-            mw.col.addNote(note)
-            logging.debug("!notecreate %s", note)
-
-    def create_mask_img(self, q_elm, fill, alpha_ch, q_wrapper_img, q_wrapper_svg):
-        """Process mask image"""
-        # PIL.Image.new() doesn't accept float coordinates, hence we're working with int coords.
-        (qe_width, qe_height) = (float(q_elm.get('width')), float(q_elm.get('height'))) # Error Raises if Reverse pattern is applied on regular layer
-        (qe_x, qe_y) = (float(q_elm.get('x')), float(q_elm.get('y'))) # qe means q_elm
-        q_mask = Image.new('RGB', (int(qe_width), int(qe_height)), fill)
-        q_mask.putalpha(alpha_ch)
-        # rotate image
-        if q_elm.get('transform'):
-            angle = float(q_elm.get('transform').split()[0].split('(')[1])
-            q_mask = q_mask.rotate(-angle, expand=True)
-        # calculate relative position for q_mask
-        (qw_x, qw_y) = (float(q_wrapper_svg.get('x')), float(q_wrapper_svg.get('y')))
-        (left, top) = (int(qe_x-qw_x)+1, int(qe_y-qw_y)+1)
-        q_wrapper_img.paste(q_mask, (left, top), mask=q_mask)
-
-    def get_qwrapper_img(self, q_wrapper, src_img):
-        (qw_x, qw_y, qw_width, qw_height) = (float(q_wrapper.get('x')), float(q_wrapper.get('y')), # qw means q_wrapper
-                                            float(q_wrapper.get('width')), float(q_wrapper.get('height')))
-        (left, top, right, bottom) = (qw_x, qw_y, qw_x+qw_width, qw_y+qw_height)
-        qw_crop_area = (left, top, right, bottom)
-        cropped_qw = src_img.crop(qw_crop_area)
-        return cropped_qw
-
-    def _generateMaskSVGsForRegular(self, side):
-        """Generate a mask for each regular questions"""
-        masks = []
-        images_obj = []
-        src_img = Image.open(self.image_path)
-        
-        if side == 'Q':
-            for q_elm_idx in self.mnode_ids.keys(): # elm might be rect/g/path/shape
-                svg_node = ET.fromstring(self.new_svg)
-                layer_nodes = self._layerNodesFrom(svg_node)
-                mlayer_node = layer_nodes[-1]  # treat topmost layer as masks layer
-                
-                for elm in svg_node.iter(): # hide all shapes from root
-                    elm.set('opacity', '0')
-
-                logging.debug(f'self.image_path: {self.image_path}')
-                logging.debug(f'src_img: {src_img}')
-                q_wrapper = mlayer_node[q_elm_idx + 1]
-                # get question wrapper img
-                cropped_qw_img = self.get_qwrapper_img(q_wrapper, src_img)
-
-                q_elm = mlayer_node[q_elm_idx]
-                q_elm.set('class', 'qshape')
-
-                if q_elm.get('fill'): # elms except g
-                    q_elm.set('fill', self.qfill)
-                    # process question image mask
-                    self.create_mask_img(q_elm, self.qfill, 255, cropped_qw_img, q_wrapper) # 255 means no transparency
-                else: # elms only g
-                    for q_shape in q_elm.findall('*'):
-                        if q_shape.get('fill') != 'none': # these are q shapes 
-                            q_shape.set('class', 'qshape')
-                            q_shape.set('fill', self.qfill)
-                            # process multiple masked question image mask
-                            self.create_mask_img(q_shape, self.qfill, 255, cropped_qw_img, q_wrapper)
-                        else: # these are ommitting shapes, shape fill is set to none
-                            q_shape.set('fill', self.hider_col)
-                            q_shape.set('class', 'hider')
-                            # process hider image mask
-                            self.create_mask_img(q_shape, self.hider_fill, 255, cropped_qw_img, q_wrapper)
-
-                # preserved elms -> root, layers, titles, current q elms
-                preserved_shapes_all = [svg_node, svg_node[0], svg_node[0][0], svg_node[1], 
-                                    svg_node[1][0], svg_node[2], svg_node[2][0]]
-                if q_elm.tag == self._ns('rect'): # this is a simple single q shape
-                    preserved_shapes_ques = [q_elm]
-                elif q_elm.tag == self._ns('g'): # this is a g containing q shapes and hiders
-                    preserved_shapes_all += [q_elm]
-                    preserved_shapes_ques = svg_node.find('.//*[@class="qshape"]').findall('*') # preserve shapes with parent having class=qshape
-                preserved_shapes_all += preserved_shapes_ques
-                
-
-                for elm in svg_node.iter():
-                    if elm in preserved_shapes_all: # unhide current q shapes and default shapes
-                        del elm.attrib['opacity']
-
-                for elm in svg_node.iter(): # set heavy fill to current q shapes and hiders
-                    if elm in preserved_shapes_ques:
-                        elm.set('opacity', '1')
-
-                inversed_wrapper = self.inverse_wrapper(q_wrapper, svg_node, self.regular_inverse_fill)
-                svg_node.append(inversed_wrapper)
-                xml = self.remove_namespace(ET.tostring(svg_node).decode('utf-8'))
-                masks.append(xml)
-                images_obj.append(cropped_qw_img)
-
-        elif side == 'A':
-            for q_elm_idx in self.mnode_ids.keys(): # elm might be rect/g/path/shape
-                svg_node = ET.fromstring(self.new_svg)
-                layer_nodes = self._layerNodesFrom(svg_node)
-                mlayer_node = layer_nodes[-1]  # treat topmost layer as masks layer
-                
-                for elm in svg_node.iter(): # hide all shapes from root
-                    elm.set('opacity', '0')
-
-                q_wrapper = mlayer_node[q_elm_idx + 1]
-                cropped_qw_img = self.get_qwrapper_img(q_wrapper, src_img)
-
-                q_elm = mlayer_node[q_elm_idx]
-                q_elm.set('class', 'ashape')
-
-                if q_elm.get('fill'): # elms except g
-                    # q_elm.set('fill', self.qfill)
-                    # process answer image mask
-                    self.create_mask_img(q_elm, self.afill, 50, cropped_qw_img, q_wrapper)
-                else: # elms only g
-                    for q_shape in q_elm.findall('*'):
-                        if q_shape.get('fill') != 'none': # these are q shapes 
-                            q_shape.set('class', 'ashape')
-                            # q_shape.set('fill', self.qfill)
-                            # process multiple masked answer image mask
-                            self.create_mask_img(q_shape, self.afill, 50, cropped_qw_img, q_wrapper)
-                            
-                        else: # these are ommitting shapes, shape fill is set to none
-                            q_shape.set('fill', self.hider_col)
-                            q_shape.set('class', 'hider')
-                            # process hider image mask
-                            self.create_mask_img(q_shape, self.hider_fill, 255, cropped_qw_img, q_wrapper)
-
-                # preserved elms -> root, layers, titles, current q elms
-                preserved_shapes_all = [svg_node, svg_node[0], svg_node[0][0], svg_node[1], 
-                                    svg_node[1][0], svg_node[2], svg_node[2][0]]
-                if q_elm.tag == self._ns('rect'): # this is a simple single q shape
-                    preserved_shapes_ques = [q_elm]
-                elif q_elm.tag == self._ns('g'): # this is a g containing q shapes and hiders
-                    preserved_shapes_all += [q_elm]
-                    preserved_shapes_ques = svg_node.find('.//*[@class="ashape"]').findall('*') # preserve shapes with parent having class=qshape
-                preserved_shapes_all += preserved_shapes_ques
-                
-
-                for elm in svg_node.iter():
-                    if elm in preserved_shapes_all: # unhide current q shapes and default shapes
-                        del elm.attrib['opacity']
-
-                for elm in svg_node.iter(): # set slight fill to q shapes and heavy fill to hiders
-                    if elm in preserved_shapes_ques:
-                        if elm.get('class') == 'hider':
-                            elm.set('opacity', '1')
-                        else:
-                            elm.set('opacity', '0.3')
-
-                # q_wrapper = mlayer_node[q_elm_idx + 1]
-                inversed_wrapper = self.inverse_wrapper(q_wrapper, svg_node, self.regular_inverse_fill)
-                svg_node.append(inversed_wrapper)
-                xml = self.remove_namespace(ET.tostring(svg_node).decode('utf-8'))
-                masks.append(xml)
-                images_obj.append(cropped_qw_img)
-        return masks, images_obj
-                
-    def _generateMaskSVGsForReverse(self, side):
-        """Generate a mask for each reverse question """
-        masks = []
-        images_obj = []
-        src_img = Image.open(self.image_path)
-
-        if side == 'Q':
-            for q_g_idx in self.rnode_ids.keys(): # g is question set
-                for q_elm_idx in self.rnode_ids[q_g_idx]:
-                    svg_node = ET.fromstring(self.new_svg)
-                    layer_nodes = self._layerNodesFrom(svg_node)
-                    rlayer_node = layer_nodes[-2]  # treat 2nd topmost layer as reverse masks layer
-
-                    for elm in svg_node.iter(): # hide all shapes from root
-                        elm.set('opacity', '0')
-
-                    q_wrapper = rlayer_node[q_g_idx + 1]
-
-                    qset_elm = rlayer_node[q_g_idx]
-                    # get question wrapper img
-                    cropped_qw_img = self.get_qwrapper_img(q_wrapper, src_img)
-
-                    qset_elm.set('class', 'qset')
-                    q_elm = qset_elm[q_elm_idx] # this is a single question -> rect/g
-                    q_elm.set('class', 'qshape')
-                    if q_elm.get('fill'): # elms except g
-                        q_elm.set('fill', self.rev_qfill)
-                        # process question image mask
-                        self.create_mask_img(q_elm, self.rev_qfill, 255, cropped_qw_img, q_wrapper) # 255 means no transparency
-                    else: # elms only g
-                        for q_shape in q_elm.findall('*'):
-                            q_shape.set('class', 'qshape')
-                            q_shape.set('fill', self.rev_qfill)
-                            # process multiple masked question image mask
-                            self.create_mask_img(q_shape, self.rev_qfill, 255, cropped_qw_img, q_wrapper)
-
-                    # preserved elms -> root, layers, titles, current q elms
-                    preserved_shapes_all = [svg_node, svg_node[0], svg_node[0][0], svg_node[1], 
-                                            svg_node[1][0], svg_node[2], svg_node[2][0], qset_elm]
-                    if q_elm.tag == self._ns('rect'): # this is a simple single q shape
-                        preserved_shapes_ques = [q_elm]
-                    elif q_elm.tag == self._ns('g'): # this is a g containing attached q shape
-                        preserved_shapes_all += [q_elm]
-                        preserved_shapes_ques = q_elm.findall('*')
-                    preserved_shapes_ques += [i for i in  qset_elm.findall('*') if i.get('fill') == 'none']
-                    preserved_shapes_all += preserved_shapes_ques
-
-
-                    for elm in svg_node.iter():
-                        if elm in preserved_shapes_all: # unhide current q shapes and default shapes
-                            del elm.attrib['opacity']
-
-                    for elm in svg_node.iter(): # set heavy fill to current q shapes and hiders
-                        if elm in preserved_shapes_ques:
-                            if not elm.get('fill') == 'none':
-                                elm.set('opacity', '1')
-                            else:
-                                elm.set('opacity', '1')
-                                elm.set('fill', self.hider_col)
-                                elm.set('class', 'hider')
-                                # process hider image mask
-                                self.create_mask_img(elm, self.hider_fill, 255, cropped_qw_img, q_wrapper)
-                            
-                    inversed_wrapper = self.inverse_wrapper(q_wrapper, svg_node, self.regular_inverse_fill)
-                    svg_node.append(inversed_wrapper)
-                    xml = self.remove_namespace(ET.tostring(svg_node).decode('utf-8'))
-                    masks.append(xml)
-                    images_obj.append(cropped_qw_img)
-
-        elif side == 'A':
-            for q_g_idx in self.rnode_ids.keys(): # g is question set
-                for q_elm_idx in self.rnode_ids[q_g_idx]:
-                    svg_node = ET.fromstring(self.new_svg)
-                    layer_nodes = self._layerNodesFrom(svg_node)
-                    rlayer_node = layer_nodes[-2]  # treat 2nd topmost layer as reverse masks layer
-
-                    for elm in svg_node.iter(): # hide all shapes from root
-                        elm.set('opacity', '0')
-
-                    q_wrapper = rlayer_node[q_g_idx + 1]
-                    cropped_qw_img = self.get_qwrapper_img(q_wrapper, src_img)
-
-                    qset_elm = rlayer_node[q_g_idx]
-                    qset_elm.set('class', 'qset')
-                    q_elm = qset_elm[q_elm_idx] # this is a single question -> rect/g
-                    q_elm.set('class', 'qshape')
-                    if q_elm.get('fill'): # elms except g
-                        q_elm.set('fill', self.rev_afill)
-                        # process answer image mask
-                        self.create_mask_img(q_elm, self.rev_afill, 50, cropped_qw_img, q_wrapper)
-                    else: # elms only g
-                        for q_shape in q_elm.findall('*'):
-                            q_shape.set('class', 'qshape')
-                            q_shape.set('fill', self.rev_afill)
-                            # process multiple masked answer image mask
-                            self.create_mask_img(q_shape, self.rev_afill, 50, cropped_qw_img, q_wrapper)
-
-                    # preserved elms -> root, layers, titles, current q elms
-                    preserved_shapes_all = [svg_node, svg_node[0], svg_node[0][0], svg_node[1], 
-                                        svg_node[1][0], svg_node[2], svg_node[2][0], qset_elm]
-
-                    if q_elm.tag == self._ns('rect'): # this is a simple single q shape
-                        preserved_shapes_ques = [q_elm]
-                    elif q_elm.tag == self._ns('g'): # this is a g containing attached q shape
-                        preserved_shapes_all += [q_elm]
-                        preserved_shapes_ques = q_elm.findall('*')
-                    preserved_shapes_ques += [i for i in  qset_elm.findall('*') if i.get('fill') == 'none']
-                    preserved_shapes_all += preserved_shapes_ques
-
-
-                    for elm in svg_node.iter():
-                        if elm in preserved_shapes_all: # unhide current q shapes and default shapes
-                            del elm.attrib['opacity']
-
-                    for elm in svg_node.iter(): # set heavy fill to current q shapes and hiders
-                        if elm in preserved_shapes_ques:
-                            if not elm.get('fill') == 'none':
-                                elm.set('opacity', '0.3')
-                            else:
-                                elm.set('opacity', '1')
-                                elm.set('fill', self.hider_col)
-                                elm.set('class', 'hider')
-                                # process hider image mask
-                                self.create_mask_img(elm, self.hider_fill, 255, cropped_qw_img, q_wrapper)
-
-                    inversed_wrapper = self.inverse_wrapper(q_wrapper, svg_node, self.reverse_inverse_fill)
-                    svg_node.append(inversed_wrapper)
-                    xml = self.remove_namespace(ET.tostring(svg_node).decode('utf-8'))
-                    masks.append(xml)  
-                    images_obj.append(cropped_qw_img)
-        return masks, images_obj
-
-    def _generateMaskSVGsForBlank(self, side):
-        pass
-
-    def updateNotes(self):
-        """Update existing notes"""
-        state = "default"
-        self.uniq_id = self.opref['uniq_id']
-        self.occl_id = '%s-%s' % (self.uniq_id, self.occl_tp)
-        omask_path = None
-
-        self._findAllNotes()
-        (svg_node, mlayer_node, rlayer_node, blayer_node) = self._getMnodesAndSetIds(True) ###@ edt oneln
-        if not (self.mnode_ids or self.rnode_ids or self.bnode_ids) : ###@ add oneitm
-            tooltip("No shapes left. You can't delete all cards.<br>\
-                Are you sure you set your masks correctly?")
-            return False
-        mw.checkpoint("Editing Image Occlusion Cards")
-        ret = self._deleteAndIdNotes(mlayer_node, rlayer_node, blayer_node)
-        if not ret:
-            # confirmation window rejected
-            return False
-        else:
-            (del_count, new_count) = ret
-
-        svg_node = self.strip_attr(svg_node)
-        self.new_svg = self.remove_namespace(ET.tostring(svg_node).decode('utf-8'))  # write changes to svg
-        old_svg = self._getOriginalSvg()  # load original svg
-        logging.debug(f'self.new_svg {self.new_svg}')
-        logging.debug(f'old_svg {old_svg}')
-        if self.new_svg != old_svg:
-            # updated masks
-            omask_path = self._saveMask(self.new_svg, self.occl_id, "O")
-            # qmasks = self._generateMaskSVGsFor("Q")
-            # amasks = self._generateMaskSVGsFor("A")
-            (reg_qmasks, reg_images_obj_q) = self._generateMaskSVGsForRegular("Q")
-            (reg_amasks, reg_images_obj_a) = self._generateMaskSVGsForRegular("A")
-            (rev_qmasks, rev_images_obj_q) = self._generateMaskSVGsForReverse("Q")
-            (rev_amasks, rev_images_obj_a) = self._generateMaskSVGsForReverse("A")
-            (blank_qmasks, blank_images_obj_q) = self._generateMaskSVGsForBlank("Q")
-            (blank_amasks, blank_images_obj_a) = self._generateMaskSVGsForBlank("A")
-            state = "reset"
-            logging.debug(f'reg_qmasks: {reg_qmasks}')
-            logging.debug(f'reg_amasks: {reg_amasks}')
-            logging.debug(f'reg_images_obj_q: {reg_images_obj_q}')
-            logging.debug(f'reg_images_obj_a: {reg_images_obj_a}')
-            logging.debug(f'rev_qmasks: {rev_qmasks}')
-            logging.debug(f'rev_amasks: {rev_amasks}')
-            logging.debug(f'rev_images_obj_q: {rev_images_obj_q}')
-            logging.debug(f'rev_images_obj_a: {rev_images_obj_a}')
-            logging.debug(f'blank_qmasks: {blank_qmasks}')
-            logging.debug(f'blank_amasks: {blank_amasks}')
-            logging.debug(f'blank_images_obj_q: {blank_images_obj_q}')
-            logging.debug(f'blank_images_obj_a: {blank_images_obj_a}')
-
-        image_path = mw.col.media.addFile(self.image_path)
-        img = fname2img(image_path)
-
-        # for regular q
-        logging.debug("mnode_indexes %s", self.mnode_ids.keys())
-        for nr, idx in enumerate(self.mnode_ids.keys()):
-            logging.debug("========= regular q ============")
-            logging.debug("nr %s", nr)
-            logging.debug("idx %s", idx)
-            note_id = self.mnode_ids[idx]
-            q_nid = mw.col.findNotes(f'"{self.mconfig["ioflds"]["id"]}:{note_id}"')
-            logging.debug("note_id %s", note_id)
-            logging.debug("self.nids %s", self.nids)
-            nid = self.nids[note_id]
-            logging.debug("nid %s", nid)
-            if omask_path:
-                if not q_nid:
-                    self._saveMaskAndReturnNote(omask_path, reg_qmasks[nr], reg_amasks[nr], reg_images_obj_q[nr], reg_images_obj_a[nr], img, note_id)
-            else:
-                self._saveMaskAndReturnNote(None, None, None,
-                                            img, note_id, nid)
-        # for reverse q
-        logging.debug("rnode_ids %s", self.rnode_ids)
-        nr = 0
-        for qset_idx in self.rnode_ids.keys():
-            for q_idx in self.rnode_ids[qset_idx].keys():
-                logging.debug("========= rev q ============")
-                logging.debug("nr %s", nr)
-                logging.debug("qset_idx %s", qset_idx)
-                logging.debug("q_idx %s", q_idx)
-                note_id = self.rnode_ids[qset_idx][q_idx]
-                q_nid = mw.col.findNotes(f'"{self.mconfig["ioflds"]["id"]}:{note_id}"')
-                logging.debug("note_id %s", note_id)
-                logging.debug("self.nids %s", self.nids)
-                nid = self.nids[note_id]
-                logging.debug("nid %s", nid)
-                if omask_path:
-                    if not q_nid:
-                        self._saveMaskAndReturnNote(omask_path, rev_qmasks[nr], rev_amasks[nr], rev_images_obj_q[nr], rev_images_obj_a[nr], img, note_id)
-                else:
-                    self._saveMaskAndReturnNote(None, None, None,
-                                                img, note_id, nid)
-                nr+=1
-
-        # for blank q
-        logging.debug("bnode_indexes %s", self.bnode_ids.keys())
-        for nr, idx in enumerate(self.bnode_ids.keys()):
-            logging.debug("========= blank q ============")
-            logging.debug("nr %s", nr)
-            logging.debug("idx %s", idx)
-            note_id = self.bnode_ids[idx]
-            q_nid = mw.col.findNotes(f'"{self.mconfig["ioflds"]["id"]}:{note_id}"')
-            logging.debug("note_id %s", note_id)
-            logging.debug("self.nids %s", self.nids)
-            nid = self.nids[note_id]
-            logging.debug("nid %s", nid)
-            if omask_path:
-                if not q_nid:
-                    self._saveMaskAndReturnNote(omask_path, blank_qmasks[nr], blank_amasks[nr], blank_images_obj_q[nr], blank_images_obj_a[nr], img, note_id)
-            else:
-                self._saveMaskAndReturnNote(None, None, None,
-                                            img, note_id, nid)
-        self._showUpdateTooltip(del_count, new_count)
-        return state
-
-    def generateNotes(self):
-        """Generate new notes"""
-        state = "default"
-        epoch_secs = int(time.time())
-        self.uniq_id = str(epoch_secs) # unique id is epoch as seconds
-        self.occl_id = '%s-%s' % (self.uniq_id, self.occl_tp)
-
-        self.unedited_q_ids = []
-        
-        ###@ add block end
-        
-        # if len(self.mnode_ids.keys()) < 2:
-        #     tooltip("You did not add  a question wrapper.<br>\
-        #         Please create one more shape to be counted as question wrapper.")
-        #     return False
-        (svg_node, layer_node, rlayer_node, blayer_node) = self._getMnodesAndSetIds() ### edt oneln
-        if not (self.mnode_ids or self.rnode_ids or self.bnode_ids):
-            tooltip("No cards to generate.<br>\
-                Are you sure you set your masks correctly?")
-            return False
-
-        svg_node = self.strip_attr(svg_node)
-        self.new_svg = self.remove_namespace(ET.tostring(svg_node).decode('utf-8')) # write changes to svg ###@ edt oneitm
-        omask_path = self._saveMask(self.new_svg, self.occl_id, "O")
-        (reg_qmasks, reg_images_obj_q) = self._generateMaskSVGsForRegular("Q")
-        (reg_amasks, reg_images_obj_a) = self._generateMaskSVGsForRegular("A") # reg_amasks are obsolete
-        (rev_qmasks, rev_images_obj_q) = self._generateMaskSVGsForReverse("Q")
-        (rev_amasks, rev_images_obj_a) = self._generateMaskSVGsForReverse("A") # rev_amasks are obsolete
-        (blank_qmasks, blank_images_obj_q) = self._generateMaskSVGsForBlank("Q")
-        (blank_amasks, blank_images_obj_a) = self._generateMaskSVGsForBlank("A")
-        logging.debug(f'reg_qmasks {reg_qmasks}')
-        logging.debug(f'reg_amasks {reg_amasks}') # reg_amasks are obsolete
-        logging.debug(f'reg_images_obj_q {reg_images_obj_q}')
-        logging.debug(f'reg_amasks_obj_a {reg_images_obj_a}')
-        logging.debug(f'rev_qmasks {rev_qmasks}')
-        logging.debug(f'rev_amasks {rev_amasks}') # rev_amasks are obsolete
-        logging.debug(f'rev_images_obj_q {rev_images_obj_q}')
-        logging.debug(f'rev_amasks_obj_a {rev_images_obj_a}')
-        image_path = mw.col.media.addFile(self.image_path)
-        img = fname2img(image_path)
-
-        mw.checkpoint("Adding Image Occlusion Cards")
-        # add regular questions
-        for nr, idx in enumerate(self.mnode_ids.keys()):
-            note_id = self.mnode_ids[idx]
-            self._saveMaskAndReturnNote(omask_path, reg_qmasks[nr], reg_amasks[nr], reg_images_obj_q[nr], reg_images_obj_a[nr], img, note_id)
-
-        # add reverse questions
-        nr = 0                          
-        for g_idx in self.rnode_ids.keys():
-            for rnode_idx in self.rnode_ids[g_idx]:
-                note_id = self.rnode_ids[g_idx][rnode_idx]
-                self._saveMaskAndReturnNote(omask_path, rev_qmasks[nr], rev_amasks[nr], rev_images_obj_q[nr], rev_images_obj_a[nr], img, note_id)
-                nr += 1
-
-        # add blank questions
-        for nr, idx in enumerate(self.bnode_ids.keys()):
-            note_id = self.bnode_ids[idx]
-            self._saveMaskAndReturnNote(omask_path, blank_qmasks[nr], blank_amasks[nr], blank_images_obj_q[nr], blank_images_obj_a[nr], img, note_id)
-
-        tooltip(f"{len(reg_qmasks)+len(rev_qmasks)+len(blank_qmasks)} cards <b>added.</b><br> \
-            regular: {len(reg_qmasks)}<br>reverse: {len(rev_qmasks)}<br>blank: {len(blank_qmasks)}", parent=None)
-        return state
+        self._writeNote(fields, nid)
+
+    def _clipField(self, img, clip, overlay_svg):
+        """Image field showing the clip box of the source image in img"""
+        ((left, top, right, bottom), (src_width, src_height)) = clip
+        (width, height) = (right - left, bottom - top)
+        if width <= 0 or height <= 0:
+            return ''
+        percent = lambda value: quantize(str(value * 100), 4)
+        return self.clip_html % {
+            'width': width, 'ratio': percent(height / width),
+            'src': img2path(img, True), 'left': percent(-left / width),
+            'top': percent(-top / height), 'scale': percent(src_width / width),
+            'svg': overlay_svg}
+
+    def _saveCardNote(self, omask_path, card_masks, img, note_id, nid=None):
+        """Write note of a card, card_masks is None if occlusions are unchanged"""
+        if card_masks is None:
+            return self._saveFieldsNote(omask_path, img, note_id, nid)
+        return self._saveMaskAndReturnNote(omask_path, card_masks.qmask, card_masks.amask,
+                                           card_masks.q_img, card_masks.a_img,
+                                           img, note_id, nid, card_masks.overlay)
 
 
 class IoGenSLI(IoGenLI):
@@ -1751,499 +1415,11 @@ class IoGenSLI(IoGenLI):
     Simplified Li
     """
     occl_tp = "sli"
+    mask_builder = SLIMaskBuilder
 
     def __init__(self, ed, svg, image_path, opref, tags, fields, did, note_tp):
         self.note_tp = 'sli'
         IoGenLI.__init__(self, ed, svg, image_path,
                                      opref, tags, fields, did, note_tp)
 
-    def remove_backgrounds(self, sub_qwrappers_svg, hider_fill, big_qwrect_img, big_qwrect_area):
-        # bqwrect means big question wrapper rectangle
-        (bqwrect_left, bqwrect_top, bqwrect_right, bqwrect_bottom) = big_qwrect_area
-        (bqwrect_width, bqwrect_height) = (bqwrect_right - bqwrect_left, bqwrect_bottom - bqwrect_top)
-        new_bqwrect = Image.new('RGB', (int(bqwrect_width) + 1, int(bqwrect_height) + 1), hider_fill)
-        for sqw in sub_qwrappers_svg:
-            # calculate relative position for sub_qwrapper
-            (sqw_x, sqw_y, sqw_width, sqw_height) = (float(sqw.get('x')), float(sqw.get('y')), 
-                                                     float(sqw.get('width')), float(sqw.get('height')))
-            (sqw_left, sqw_top, sqw_right, sqw_bottom) = (sqw_x, sqw_y, # absolute coords
-                                                            sqw_x + sqw_width, sqw_y + sqw_height)
-            (sqw_left, sqw_top, sqw_right, sqw_bottom) = (sqw_left - bqwrect_left, # relative coords
-                                sqw_top - bqwrect_top, sqw_right - bqwrect_left, sqw_bottom - bqwrect_top) #bqwrect_right - sqw_right, bqwrect_bottom - sqw_bottom)
-            cropped_sqw = big_qwrect_img.crop((sqw_left, sqw_top, sqw_right, sqw_bottom))
-            new_bqwrect.paste(cropped_sqw, (int(sqw_left), int(sqw_top)))
-        return new_bqwrect
-
-    def create_mask_img_multi_wrapper(self, q_elm, fill, alpha_ch, q_wrapper_img, qwrapper_area):
-        """Process mask image"""
-        # PIL.Image.new() doesn't accept float coordinates, hence we're working with int coords.
-        (qe_width, qe_height) = (float(q_elm.get('width')), float(q_elm.get('height'))) # Error Raises if Reverse pattern is applied on regular layer
-        (qe_x, qe_y) = (float(q_elm.get('x')), float(q_elm.get('y'))) # qe means q_elm
-        q_mask = Image.new('RGB', (int(qe_width), int(qe_height)), fill)
-        q_mask.putalpha(alpha_ch)
-        # calculate relative position for q_mask
-        (qw_x, qw_y, _, _) = (qwrapper_area)
-        (left, top) = (int(qe_x-qw_x)+1, int(qe_y-qw_y)+1)
-        q_wrapper_img.paste(q_mask, (left, top), mask=q_mask)
-
-    def create_mask_img(self, q_elm, fill, alpha_ch, src_img):
-        """Process mask image"""
-        # PIL.Image.new() doesn't accept float coordinates, hence we're working with int coords.
-        (qe_width, qe_height) = (float(q_elm.get('width')), float(q_elm.get('height'))) # Error Raises if Reverse pattern is applied on regular layer
-        (qe_x, qe_y) = (float(q_elm.get('x')), float(q_elm.get('y'))) # qe means q_elm
-        q_mask = Image.new('RGB', (int(qe_width)+1, int(qe_height)+1), fill)
-        q_mask.putalpha(alpha_ch)
-        # rotate image
-        if q_elm.get('transform'):
-            angle = float(q_elm.get('transform').split()[0].split('(')[1])
-            q_mask = q_mask.rotate(-angle, expand=True)
-        src_img.paste(q_mask, (int(qe_x)+1, int(qe_y)+1), mask=q_mask)
-
-    def get_mult_qwrapper_img(self, big_qrect_area, src_img):
-        """Get big rectangle area for multiple qwrapper"""
-        (left, top, right, bottom) = big_qrect_area
-        qw_crop_area = (left, top, right, bottom)
-        cropped_qw = src_img.crop(qw_crop_area)
-        return cropped_qw
-
-    def get_surrounding_rect_from_sub_rects(self, sub_rects_svg):
-        big_rect_left = sorted([float(i.get('x')) for i in sub_rects_svg])[0] # smallest x
-        big_rect_top = sorted([float(i.get('y')) for i in sub_rects_svg])[0] # smallest y
-        big_rect_right = sorted([float(i.get('x'))+float(i.get('width')) for i in sub_rects_svg])[-1] # biggest x+width
-        big_rect_bottom = sorted([float(i.get('y'))+float(i.get('height')) for i in sub_rects_svg])[-1] # biggest y+height
-        return (big_rect_left, big_rect_top, big_rect_right, big_rect_bottom)
-
-    def _generateMaskSVGsForRegular(self, side):
-        """Generate a mask for each regular questions"""
-        masks = []
-        images_obj = []
-        src_img = Image.open(self.image_path)
-        
-        if side == 'Q':
-            for q_elm_idx in self.mnode_ids.keys(): # elm might be rect/g/path/shape
-                src_img_copy = src_img.copy()
-                svg_node = ET.fromstring(self.new_svg)
-                layer_nodes = self._layerNodesFrom(svg_node)
-                mlayer_node = layer_nodes[-1]  # treat topmost layer as masks layer
-                
-                for elm in svg_node.iter(): # hide all shapes from root
-                    elm.set('opacity', '0')
-
-                logging.debug(f'self.image_path: {self.image_path}')
-                logging.debug(f'src_img: {src_img}')
-
-                q_elm = mlayer_node[q_elm_idx]
-                q_elm.set('class', 'qshape')
-
-                if q_elm.get('fill'): # elms except g
-                    q_elm.set('fill', self.qfill)
-                    # process question image mask
-                    self.create_mask_img(q_elm, self.qfill, 255, src_img_copy) # 255 means no transparency
-                else: # elms only g
-                    for q_shape in q_elm.findall('*'):
-                        if q_shape.get('fill') != 'none': # these are q shapes 
-                            q_shape.set('class', 'qshape')
-                            q_shape.set('fill', self.qfill)
-                            # process multiple masked question image mask
-                            self.create_mask_img(q_shape, self.qfill, 255, src_img_copy)
-                        else: # these are ommitting shapes, shape fill is set to none
-                            q_shape.set('fill', self.hider_col)
-                            q_shape.set('class', 'hider')
-                            # process hider image mask
-                            self.create_mask_img(q_shape, self.hider_fill, 255, src_img_copy)
-
-                q_wrapper = mlayer_node[q_elm_idx + 1]
-                if q_wrapper.tag == self._ns('rect'): # single qwrapper
-                    multi_wrapper = False
-                    # get question wrapper img
-                    cropped_qw_img = self.get_qwrapper_img(q_wrapper, src_img_copy)
-                elif q_wrapper.tag == self._ns('g'): # multiple qwrapper
-                    multi_wrapper = True
-                    sub_qwrappers = q_wrapper.findall('*')
-                    qwrects_big_wrapper_area = self.get_surrounding_rect_from_sub_rects(sub_qwrappers)
-        
-                    # get multiple question wrapper big rectangle img
-                    cropped_qw_img = self.get_mult_qwrapper_img(qwrects_big_wrapper_area, src_img_copy)
-
-                # preserved elms -> root, layers, titles, current q elms
-                preserved_shapes_all = [svg_node, svg_node[0], svg_node[0][0], svg_node[1], 
-                                    svg_node[1][0], svg_node[2], svg_node[2][0]]
-                if q_elm.tag == self._ns('rect'): # this is a simple single q shape
-                    preserved_shapes_ques = [q_elm]
-                elif q_elm.tag == self._ns('g'): # this is a g containing q shapes and hiders
-                    preserved_shapes_all += [q_elm]
-                    preserved_shapes_ques = svg_node.find('.//*[@class="qshape"]').findall('*') # preserve shapes with parent having class=qshape
-                preserved_shapes_all += preserved_shapes_ques
-                
-
-                for elm in svg_node.iter():
-                    if elm in preserved_shapes_all: # unhide current q shapes and default shapes
-                        del elm.attrib['opacity']
-
-                for elm in svg_node.iter(): # set heavy fill to current q shapes and hiders
-                    if elm in preserved_shapes_ques:
-                        elm.set('opacity', '1')
-
-                if multi_wrapper:
-                    # bqwrect means big question wrapper rectangle
-                    cropped_qw_img = self.remove_backgrounds(sub_qwrappers, self.hider_fill, 
-                                    cropped_qw_img, qwrects_big_wrapper_area)
-
-                # inversed_wrapper = self.inverse_wrapper(q_wrapper, svg_node, self.regular_inverse_fill)
-                # TODO implement svg wrapping, currently disabled with demo xml
-                # inversed_wrapper = '<svg width="1075" height="1519" xmlns="http://www.w3.org/2000/svg"></svg>'
-                # svg_node.append(inversed_wrapper)
-                xml = self.remove_namespace(ET.tostring(svg_node).decode('utf-8'))
-                # TODO implement svg wrapping, currently disabled with demo xml
-                # xml = '<svg width="1075" height="1519" xmlns="http://www.w3.org/2000/svg"></svg>'
-                masks.append(xml)
-                images_obj.append(cropped_qw_img)
-
-        elif side == 'A':
-            for q_elm_idx in self.mnode_ids.keys(): # elm might be rect/g/path/shape
-                src_img_copy = src_img.copy()
-                svg_node = ET.fromstring(self.new_svg)
-                layer_nodes = self._layerNodesFrom(svg_node)
-                mlayer_node = layer_nodes[-1]  # treat topmost layer as masks layer
-                
-                for elm in svg_node.iter(): # hide all shapes from root
-                    elm.set('opacity', '0')
-
-                q_elm = mlayer_node[q_elm_idx]
-                q_elm.set('class', 'ashape')
-
-                if q_elm.get('fill'): # elms except g
-                    # q_elm.set('fill', self.qfill)
-                    # process answer image mask
-                        self.create_mask_img(q_elm, self.afill, 50, src_img_copy) # 255 means no transparency
-                else: # elms only g
-                    for q_shape in q_elm.findall('*'):
-                        if q_shape.get('fill') != 'none': # these are q shapes 
-                            q_shape.set('class', 'ashape')
-                            # q_shape.set('fill', self.qfill)
-                            # process multiple masked answer image mask
-                            self.create_mask_img(q_shape, self.afill, 50, src_img_copy)
-                            
-                        else: # these are ommitting shapes, shape fill is set to none
-                            q_shape.set('fill', self.hider_col)
-                            q_shape.set('class', 'hider')
-                            # process hider image mask
-                            self.create_mask_img(q_shape, self.hider_fill, 255, src_img_copy)
-
-                q_wrapper = mlayer_node[q_elm_idx + 1]
-                if q_wrapper.tag == self._ns('rect'): # single qwrapper
-                    multi_wrapper = False
-                    # get question wrapper img
-                    cropped_qw_img = self.get_qwrapper_img(q_wrapper, src_img_copy)
-                elif q_wrapper.tag == self._ns('g'): # multiple qwrapper
-                    multi_wrapper = True
-                    sub_qwrappers = q_wrapper.findall('*')
-                    qwrects_big_wrapper_area = self.get_surrounding_rect_from_sub_rects(sub_qwrappers)
-        
-                    # get multiple question wrapper big rectangle img
-                    cropped_qw_img = self.get_mult_qwrapper_img(qwrects_big_wrapper_area, src_img_copy)
-                
-                # preserved elms -> root, layers, titles, current q elms
-                preserved_shapes_all = [svg_node, svg_node[0], svg_node[0][0], svg_node[1], 
-                                    svg_node[1][0], svg_node[2], svg_node[2][0]]
-                if q_elm.tag == self._ns('rect'): # this is a simple single q shape
-                    preserved_shapes_ques = [q_elm]
-                elif q_elm.tag == self._ns('g'): # this is a g containing q shapes and hiders
-                    preserved_shapes_all += [q_elm]
-                    preserved_shapes_ques = svg_node.find('.//*[@class="ashape"]').findall('*') # preserve shapes with parent having class=qshape
-                preserved_shapes_all += preserved_shapes_ques
-                
-
-                for elm in svg_node.iter():
-                    if elm in preserved_shapes_all: # unhide current q shapes and default shapes
-                        del elm.attrib['opacity']
-
-                for elm in svg_node.iter(): # set slight fill to q shapes and heavy fill to hiders
-                    if elm in preserved_shapes_ques:
-                        if elm.get('class') == 'hider':
-                            elm.set('opacity', '1')
-                        else:
-                            elm.set('opacity', '0.3')
-
-                if multi_wrapper:
-                    # bqwrect means big question wrapper rectangle
-                    cropped_qw_img = self.remove_backgrounds(sub_qwrappers, self.hider_fill, 
-                                    cropped_qw_img, qwrects_big_wrapper_area)
-
-                # inversed_wrapper = self.inverse_wrapper(q_wrapper, svg_node, self.regular_inverse_fill)
-                # TODO implement svg wrapping, currently disabled with demo xml
-                # inversed_wrapper = '<svg width="1075" height="1519" xmlns="http://www.w3.org/2000/svg"></svg>'
-                # svg_node.append(inversed_wrapper)
-                xml = self.remove_namespace(ET.tostring(svg_node).decode('utf-8'))
-                # TODO implement svg wrapping, currently disabled with demo xml
-                # xml = '<svg width="1075" height="1519" xmlns="http://www.w3.org/2000/svg"></svg>'
-                masks.append(xml)
-                images_obj.append(cropped_qw_img)
-        return masks, images_obj
-
-    def _generateMaskSVGsForReverse(self, side):
-        """Generate a mask for each reverse question """
-        masks = []
-        images_obj = []
-        src_img = Image.open(self.image_path)
-
-        if side == 'Q':
-            for q_g_idx in self.rnode_ids.keys(): # g is question set
-                for q_elm_idx in self.rnode_ids[q_g_idx]:
-                    src_img_copy = src_img.copy()
-                    svg_node = ET.fromstring(self.new_svg)
-                    layer_nodes = self._layerNodesFrom(svg_node)
-                    rlayer_node = layer_nodes[-2]  # treat 2nd topmost layer as reverse masks layer
-
-                    for elm in svg_node.iter(): # hide all shapes from root
-                        elm.set('opacity', '0')
-
-
-                    qset_elm = rlayer_node[q_g_idx]
-
-                    qset_elm.set('class', 'qset')
-                    q_elm = qset_elm[q_elm_idx] # this is a single question -> rect/g
-                    q_elm.set('class', 'qshape')
-                    if q_elm.get('fill'): # elms except g
-                        q_elm.set('fill', self.rev_qfill)
-                        # process question image mask
-                        self.create_mask_img(q_elm, self.rev_qfill, 255, src_img_copy) # 255 means no transparency
-                    else: # elms only g
-                        for q_shape in q_elm.findall('*'):
-                            q_shape.set('class', 'qshape')
-                            q_shape.set('fill', self.rev_qfill)
-                            # process multiple masked question image mask
-                            self.create_mask_img(q_shape, self.rev_qfill, 255, src_img_copy)
-
-                    q_wrapper = rlayer_node[q_g_idx + 1]
-                    if q_wrapper.tag == self._ns('rect'): # single qwrapper
-                        multi_wrapper = False
-                        # get question wrapper img
-                        cropped_qw_img = self.get_qwrapper_img(q_wrapper, src_img_copy)
-                    elif q_wrapper.tag == self._ns('g'): # multiple qwrapper
-                        multi_wrapper = True
-                        sub_qwrappers = q_wrapper.findall('*')
-                        qwrects_big_wrapper_area = self.get_surrounding_rect_from_sub_rects(sub_qwrappers)
-            
-                        # get multiple question wrapper big rectangle img
-                        cropped_qw_img = self.get_mult_qwrapper_img(qwrects_big_wrapper_area, src_img_copy)
-                        
-                    # preserved elms -> root, layers, titles, current q elms
-                    preserved_shapes_all = [svg_node, svg_node[0], svg_node[0][0], svg_node[1], 
-                                            svg_node[1][0], svg_node[2], svg_node[2][0], qset_elm]
-                    if q_elm.tag == self._ns('rect'): # this is a simple single q shape
-                        preserved_shapes_ques = [q_elm]
-                    elif q_elm.tag == self._ns('g'): # this is a g containing attached q shape
-                        preserved_shapes_all += [q_elm]
-                        preserved_shapes_ques = q_elm.findall('*')
-                    preserved_shapes_ques += [i for i in  qset_elm.findall('*') if i.get('fill') == 'none']
-                    preserved_shapes_all += preserved_shapes_ques
-
-
-                    for elm in svg_node.iter():
-                        if elm in preserved_shapes_all: # unhide current q shapes and default shapes
-                            del elm.attrib['opacity']
-
-                    for elm in svg_node.iter(): # set heavy fill to current q shapes and hiders
-                        if elm in preserved_shapes_ques:
-                            if not elm.get('fill') == 'none':
-                                elm.set('opacity', '1')
-                            else:
-                                elm.set('opacity', '1')
-                                elm.set('fill', self.hider_col)
-                                elm.set('class', 'hider')
-                                # process hider image mask
-                                self.create_mask_img(elm, self.hider_fill, 255, src_img_copy)
-
-                    if multi_wrapper:
-                        # bqwrect means big question wrapper rectangle
-                        cropped_qw_img = self.remove_backgrounds(sub_qwrappers, self.hider_fill, 
-                                        cropped_qw_img, qwrects_big_wrapper_area)
-                            
-                    # inversed_wrapper = self.inverse_wrapper(q_wrapper, svg_node, self.regular_inverse_fill)
-                    # svg_node.append(inversed_wrapper)
-                    xml = self.remove_namespace(ET.tostring(svg_node).decode('utf-8'))
-                    masks.append(xml)
-                    images_obj.append(cropped_qw_img)
-
-        elif side == 'A':
-            for q_g_idx in self.rnode_ids.keys(): # g is question set
-                for q_elm_idx in self.rnode_ids[q_g_idx]:
-                    src_img_copy = src_img.copy()
-                    svg_node = ET.fromstring(self.new_svg)
-                    layer_nodes = self._layerNodesFrom(svg_node)
-                    rlayer_node = layer_nodes[-2]  # treat 2nd topmost layer as reverse masks layer
-
-                    for elm in svg_node.iter(): # hide all shapes from root
-                        elm.set('opacity', '0')
-
-                    qset_elm = rlayer_node[q_g_idx]
-                    qset_elm.set('class', 'qset')
-                    q_elm = qset_elm[q_elm_idx] # this is a single question -> rect/g
-                    q_elm.set('class', 'qshape')
-                    if q_elm.get('fill'): # elms except g
-                        q_elm.set('fill', self.rev_afill)
-                        # process answer image mask
-                        self.create_mask_img(q_elm, self.rev_afill, 50, src_img_copy) # 255 means no transparency
-                    else: # elms only g
-                        for q_shape in q_elm.findall('*'):
-                            q_shape.set('class', 'qshape')
-                            q_shape.set('fill', self.rev_afill)
-                            # process multiple masked answer image mask
-                            self.create_mask_img(q_shape, self.rev_afill, 50, src_img_copy)
-
-                    q_wrapper = rlayer_node[q_g_idx + 1]
-                    if q_wrapper.tag == self._ns('rect'): # single qwrapper
-                        multi_wrapper = False
-                        # get question wrapper img
-                        cropped_qw_img = self.get_qwrapper_img(q_wrapper, src_img_copy)
-                    elif q_wrapper.tag == self._ns('g'): # multiple qwrapper
-                        multi_wrapper = True
-                        sub_qwrappers = q_wrapper.findall('*')
-                        qwrects_big_wrapper_area = self.get_surrounding_rect_from_sub_rects(sub_qwrappers)
-            
-                        # get multiple question wrapper big rectangle img
-                        cropped_qw_img = self.get_mult_qwrapper_img(qwrects_big_wrapper_area, src_img_copy)
-                    
-                    # preserved elms -> root, layers, titles, current q elms
-                    preserved_shapes_all = [svg_node, svg_node[0], svg_node[0][0], svg_node[1], 
-                                        svg_node[1][0], svg_node[2], svg_node[2][0], qset_elm]
-
-                    if q_elm.tag == self._ns('rect'): # this is a simple single q shape
-                        preserved_shapes_ques = [q_elm]
-                    elif q_elm.tag == self._ns('g'): # this is a g containing attached q shape
-                        preserved_shapes_all += [q_elm]
-                        preserved_shapes_ques = q_elm.findall('*')
-                    preserved_shapes_ques += [i for i in  qset_elm.findall('*') if i.get('fill') == 'none']
-                    preserved_shapes_all += preserved_shapes_ques
-
-
-                    for elm in svg_node.iter():
-                        if elm in preserved_shapes_all: # unhide current q shapes and default shapes
-                            del elm.attrib['opacity']
-
-                    for elm in svg_node.iter(): # set heavy fill to current q shapes and hiders
-                        if elm in preserved_shapes_ques:
-                            if not elm.get('fill') == 'none':
-                                elm.set('opacity', '0.3')
-                            else:
-                                elm.set('opacity', '1')
-                                elm.set('fill', self.hider_col)
-                                elm.set('class', 'hider')
-                                # process hider image mask
-                                self.create_mask_img(elm, self.hider_fill, 255, src_img_copy)
-
-                    if multi_wrapper:
-                        # bqwrect means big question wrapper rectangle
-                        cropped_qw_img = self.remove_backgrounds(sub_qwrappers, self.hider_fill, 
-                                        cropped_qw_img, qwrects_big_wrapper_area)
-
-                    # inversed_wrapper = self.inverse_wrapper(q_wrapper, svg_node, self.reverse_inverse_fill)
-                    # svg_node.append(inversed_wrapper)
-                    xml = self.remove_namespace(ET.tostring(svg_node).decode('utf-8'))
-                    masks.append(xml)  
-                    images_obj.append(cropped_qw_img)
-        return masks, images_obj
-
-    def _generateMaskSVGsForBlank(self, side):
-        """Generate a mask for each regular questions"""
-        masks = []
-        images_obj = []
-        src_img = Image.open(self.image_path)
-
-        # blank image for q and a
-        blank_im = Image.new('RGB', (200, 50), self.blankq_fill)
-        
-        if side == 'Q':
-            for q_elm_idx in self.bnode_ids.keys(): # elm is a rect
-                src_img_copy = src_img.copy()
-                svg_node = ET.fromstring(self.new_svg)
-                layer_nodes = self._layerNodesFrom(svg_node)
-                blayer_node = layer_nodes[-3]  # treat topmost 3rd layer as blankQ masks layer
-                
-                for elm in svg_node.iter(): # hide all shapes from root
-                    elm.set('opacity', '0')
-
-                logging.debug(f'self.image_path: {self.image_path}')
-                logging.debug(f'src_img: {src_img}')
-
-                q_elm = blayer_node[q_elm_idx]
-                q_elm.set('class', 'qshape')
-
-                if q_elm.get('fill'): # elms except g
-                    q_elm.set('fill', self.qfill)
-
-                # preserved elms -> root, layers, titles, current q elms
-                preserved_shapes_all = [svg_node, svg_node[0], svg_node[0][0], svg_node[1], 
-                                    svg_node[1][0], svg_node[2], svg_node[2][0], svg_node[3], svg_node[3][0]]
-                if q_elm.tag == self._ns('rect'): # this is a simple single q shape
-                    preserved_shapes_ques = [q_elm]
-                preserved_shapes_all += preserved_shapes_ques
-                
-
-                for elm in svg_node.iter():
-                    if elm in preserved_shapes_all: # unhide current q shapes and default shapes
-                        del elm.attrib['opacity']
-
-                for elm in svg_node.iter(): # set heavy fill to current q shapes and hiders
-                    if elm in preserved_shapes_ques:
-                        elm.set('opacity', '1')
-
-                # inversed_wrapper = self.inverse_wrapper(q_wrapper, svg_node, self.regular_inverse_fill)
-                # TODO implement svg wrapping, currently disabled with demo xml
-                # inversed_wrapper = '<svg width="1075" height="1519" xmlns="http://www.w3.org/2000/svg"></svg>'
-                # svg_node.append(inversed_wrapper)
-                xml = self.remove_namespace(ET.tostring(svg_node).decode('utf-8'))
-                # TODO implement svg wrapping, currently disabled with demo xml
-                # xml = '<svg width="1075" height="1519" xmlns="http://www.w3.org/2000/svg"></svg>'
-                masks.append(xml)
-                images_obj.append(blank_im)
-
-        elif side == 'A':
-            for q_elm_idx in self.bnode_ids.keys(): # elm is a rect
-                src_img_copy = src_img.copy()
-                svg_node = ET.fromstring(self.new_svg)
-                layer_nodes = self._layerNodesFrom(svg_node)
-                blayer_node = layer_nodes[-3]  # treat topmost 3rd layer as blankQ masks layer
-                
-                for elm in svg_node.iter(): # hide all shapes from root
-                    elm.set('opacity', '0')
-
-                q_elm = blayer_node[q_elm_idx]
-                q_elm.set('class', 'ashape')
-
-                if q_elm.get('fill'): # elms except g
-                    # q_elm.set('fill', self.qfill)
-                    pass
-                
-                # preserved elms -> root, layers, titles, current q elms
-                preserved_shapes_all = [svg_node, svg_node[0], svg_node[0][0], svg_node[1], 
-                                    svg_node[1][0], svg_node[2], svg_node[2][0], svg_node[3], svg_node[3][0]]
-                if q_elm.tag == self._ns('rect'): # this is a simple single q shape
-                    preserved_shapes_ques = [q_elm]
-                preserved_shapes_all += preserved_shapes_ques
-                
-
-                for elm in svg_node.iter():
-                    if elm in preserved_shapes_all: # unhide current q shapes and default shapes
-                        del elm.attrib['opacity']
-
-                for elm in svg_node.iter(): # set slight fill to q shapes and heavy fill to hiders
-                    if elm in preserved_shapes_ques:
-                        if elm.get('class') == 'hider':
-                            elm.set('opacity', '1')
-                        else:
-                            elm.set('opacity', '0.3')
-
-                # inversed_wrapper = self.inverse_wrapper(q_wrapper, svg_node, self.regular_inverse_fill)
-                # TODO implement svg wrapping, currently disabled with demo xml
-                # inversed_wrapper = '<svg width="1075" height="1519" xmlns="http://www.w3.org/2000/svg"></svg>'
-                # svg_node.append(inversed_wrapper)
-                xml = self.remove_namespace(ET.tostring(svg_node).decode('utf-8'))
-                # TODO implement svg wrapping, currently disabled with demo xml
-                # xml = '<svg width="1075" height="1519" xmlns="http://www.w3.org/2000/svg"></svg>'
-                masks.append(xml)
-                images_obj.append(blank_im)
-        return masks, images_obj
-
 logging.debug(f'Exiting: {__name__}')
\ No newline at end of file
@@ -26,6 +26,16 @@ from aqt import mw
 from anki.errors import AnkiError
 
 from .config import *
+from .template import MASK_COLOUR_TYPES, update_mask_colours
+from .media import DEFAULT_IMG_ENCODER
+
+# (value, label) of the choices for generated LI/SLI images
+IMG_MODE_CHOICES = (('full', 'Question and answer image'),
+                    ('compact', 'One image, shapes drawn over it'),
+                    ('clip', 'Region of the original image, no images stored'))
+IMG_FORMAT_CHOICES = (('png', 'PNG'), ('webp', 'WebP (lossless)'),
+                      ('webp_lossy', 'WebP (lossy)'), ('jpeg', 'JPEG'),
+                      ('auto', 'Smaller of PNG and WebP'))
 
 
 class GrabKey(QDialog):
@@ -114,6 +124,7 @@ class ImgOccOpts(QDialog):
         self.hotkey = self.lconf["hotkey"]
         self.setupUi()
         self.setupValues(self.sconf)
+        self.setupLocalValues(self.lconf)
 
     def setupValues(self, config):
         """Set up widget data based on provided config dict"""
@@ -126,6 +137,28 @@ class ImgOccOpts(QDialog):
         self.swidth_sel.setValue(int(config['swidth']))
         self.font_sel.setCurrentFont(QFont(config['font']))
         self.skipped.setText(','.join(config['io_models_map']['ao']["skip_flds"]))
+        self.sparse_masks_cb.setChecked(
+            config.get('sparse_masks', self.sconf_dflt['sparse_masks']))
+        self.client_masks_cb.setChecked(
+            config.get('client_masks', self.sconf_dflt['client_masks']))
+        # LI and SLI share these settings in the dialog
+        li_map = config['io_models_map'].get('li', {})
+        img_encoder = li_map.get('img_encoder') or DEFAULT_IMG_ENCODER
+        self.setComboValue(self.img_mode_sel, li_map.get('img_mode', 'full'))
+        self.setComboValue(self.img_format_sel, img_encoder.get('format', 'png'))
+
+    def setupLocalValues(self, config):
+        """Set up widget data of the local preferences in config"""
+        self.parallel_gen_cb.setChecked(
+            config.get('parallel_gen', self.lconf_dflt['parallel_gen']))
+        self.gen_workers_sel.setValue(
+            int(config.get('gen_workers', self.lconf_dflt['gen_workers'])))
+
+    def setComboValue(self, combo, value):
+        """Select the item of combo holding value, if there is one"""
+        idx = combo.findData(value)
+        if idx != -1:
+            combo.setCurrentIndex(idx)
 
     def setupUi(self):
         """Set up widgets and layouts"""
@@ -163,6 +196,7 @@ class ImgOccOpts(QDialog):
         # Horizontal lines
         rule1 = self.create_horizontal_rule()
         rule2 = self.create_horizontal_rule()
+        rule3 = self.create_horizontal_rule()
 
         # Bottom section and grid assignment
 
@@ -240,6 +274,36 @@ class ImgOccOpts(QDialog):
         grid.addWidget(self.key_grabbed, row + 5, 2, 1, 1)
         grid.addWidget(key_grab_btn, row + 5, 3, 1, 3)
 
+        # Card generation
+        gen_heading = QLabel("<b>Card Generation</b>")
+        self.sparse_masks_cb = QCheckBox("SI/LI/SLI masks only hold the shapes of their card")
+        self.client_masks_cb = QCheckBox("AO/OA cards derive their masks from the original mask")
+        self.parallel_gen_cb = QCheckBox("Build SI/LI/SLI masks in worker threads")
+        workers_label = QLabel("Worker threads (0: one per core)")
+        self.gen_workers_sel = QSpinBox()
+        self.gen_workers_sel.setMinimum(0)
+        self.gen_workers_sel.setMaximum(64)
+        img_mode_label = QLabel("LI/SLI images")
+        self.img_mode_sel = QComboBox()
+        for value, label in IMG_MODE_CHOICES:
+            self.img_mode_sel.addItem(label, value)
+        img_format_label = QLabel("LI/SLI image format")
+        self.img_format_sel = QComboBox()
+        for value, label in IMG_FORMAT_CHOICES:
+            self.img_format_sel.addItem(label, value)
+
+        grid.addWidget(rule3, row + 6, 0, 1, 6)
+        grid.addWidget(gen_heading, row + 7, 0, 1, 6)
+        grid.addWidget(self.sparse_masks_cb, row + 8, 0, 1, 3)
+        grid.addWidget(self.client_masks_cb, row + 8, 3, 1, 3)
+        grid.addWidget(self.parallel_gen_cb, row + 9, 0, 1, 3)
+        grid.addWidget(workers_label, row + 9, 3, 1, 1)
+        grid.addWidget(self.gen_workers_sel, row + 9, 4, 1, 2)
+        grid.addWidget(img_mode_label, row + 10, 0, 1, 1)
+        grid.addWidget(self.img_mode_sel, row + 10, 1, 1, 2)
+        grid.addWidget(img_format_label, row + 10, 3, 1, 1)
+        grid.addWidget(self.img_format_sel, row + 10, 4, 1, 2)
+
         # Main button box
         button_box = QDialogButtonBox(QDialogButtonBox.Ok |
                                       QDialogButtonBox.Cancel)
@@ -255,7 +319,7 @@ class ImgOccOpts(QDialog):
         l_main.addWidget(button_box)
         self.setLayout(l_main)
         self.setMinimumWidth(800)
-        self.setMinimumHeight(640)
+        self.setMinimumHeight(760)
         self.setWindowTitle('Image Occlusion Enhanced Options')
 
     def create_horizontal_rule(self):
@@ -311,6 +375,7 @@ class ImgOccOpts(QDialog):
             self.lnedit[key].setText(IO_MODELS_MAP['ao']['flds'][key])
             self.lnedit[key].setModified(True)
         self.setupValues(self.sconf_dflt)
+        self.setupLocalValues(self.lconf_dflt)
         self.ofill = self.sconf_dflt["ofill"]
         self.qfill = self.sconf_dflt["qfill"]
         self.scol = self.sconf_dflt["scol"]
@@ -365,6 +430,20 @@ class ImgOccOpts(QDialog):
         mw.col.conf['imgocc_armod']['font'] = self.font_sel.currentFont().family()
         mw.col.conf['imgocc_armod']['io_models_map']['ao']['skip'] = self.skipped.text().split(',')
         mw.pm.profile["imgocc_armod"]["hotkey"] = self.hotkey
+        mw.col.conf['imgocc_armod']['sparse_masks'] = self.sparse_masks_cb.isChecked()
+        mw.col.conf['imgocc_armod']['client_masks'] = self.client_masks_cb.isChecked()
+        for note_tp in ('li', 'sli'):
+            model_map = mw.col.conf['imgocc_armod']['io_models_map'].setdefault(note_tp, {})
+            model_map['img_mode'] = self.img_mode_sel.currentData()
+            model_map['img_encoder'] = dict(model_map.get('img_encoder') or DEFAULT_IMG_ENCODER,
+                                            format=self.img_format_sel.currentData())
+        mw.pm.profile["imgocc_armod"]["parallel_gen"] = self.parallel_gen_cb.isChecked()
+        mw.pm.profile["imgocc_armod"]["gen_workers"] = self.gen_workers_sel.value()
+        # existing cards pick up new colours through the note type CSS
+        for note_tp in MASK_COLOUR_TYPES:
+            model = mw.col.models.byName(IO_MODELS_MAP[note_tp]['name'])
+            if model:
+                update_mask_colours(mw.col, model, mw.col.conf['imgocc_armod'])
         mw.col.setMod()
         self.close()
 
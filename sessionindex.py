@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+"""
+Sidecar index mapping occlusion sessions to the nids of their notes.
+
+The index lives next to the collection in the profile folder and is
+only a cache: a session is returned only while all of its notes are
+still unmodified since they were indexed, otherwise callers fall back
+to searching the collection and re-index the session.
+
+This module must stay free of aqt/anki imports.
+"""
+
+import logging
+logging.debug(f'Running: {__name__}')
+
+import re
+import sqlite3
+
+SESSION_INDEX_FILE = 'imgocc_armod_sessions.db'
+
+
+def occlIdOf(note_id):
+    """Occlusion session (uniq_id-occl_tp) a note id belongs to"""
+    return '-'.join(note_id.split('-')[:2])
+
+
+def cardNrOf(note_id):
+    """Card number encoded in a note id, None if there is none"""
+    match = re.search(r'-card_(\d+)', note_id)
+    return int(match.group(1)) if match else None
+
+
+class SessionIndex(object):
+    """occl_id -> (nid, note_id, card_nr, mod) of every note of a session"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _connect(self):
+        db = sqlite3.connect(self.path)
+        db.execute("""create table if not exists notes (
+                          nid integer primary key,
+                          occl_id text not null,
+                          note_id text not null,
+                          card_nr integer,
+                          mod integer not null)""")
+        db.execute("create index if not exists ix_notes_occl_id on notes (occl_id)")
+        return db
+
+    def lookup(self, occl_id):
+        """Return {nid: (note_id, mod)} of the indexed notes of occl_id"""
+        try:
+            db = self._connect()
+            try:
+                rows = db.execute("select nid, note_id, mod from notes "
+                                  "where occl_id = ?", (occl_id,)).fetchall()
+            finally:
+                db.close()
+        except sqlite3.Error as e:
+            logging.warning(f'session index unavailable: {e}')
+            return {}
+        return {nid: (note_id, mod) for nid, note_id, mod in rows}
+
+    def store(self, notes):
+        """
+        Index notes given as (nid, note_id, mod). Each session in notes is
+        replaced as a whole, notes missing from it are dropped.
+        """
+        rows = [(nid, occlIdOf(note_id), note_id, cardNrOf(note_id), mod)
+                for nid, note_id, mod in notes if note_id]
+        occl_ids = {(row[1],) for row in rows}
+        try:
+            db = self._connect()
+            try:
+                with db: # one transaction
+                    db.executemany("delete from notes where occl_id = ?", occl_ids)
+                    db.executemany("insert or replace into notes "
+                                   "values (?, ?, ?, ?, ?)", rows)
+            finally:
+                db.close()
+        except sqlite3.Error as e:
+            logging.warning(f'could not update session index: {e}')
+
+logging.debug(f'Exiting: {__name__}')
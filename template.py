@@ -19,6 +19,8 @@ Handles the IO note type and card template
 import logging
 logging.debug(f'Running: {__name__}')
 
+import re
+
 from .config import *
 from .config import IO_FLDS_OA, IO_FLDS_AO, IO_FLDS_SI, IO_FLDS_LI, DFLT_MODEL, IO_FLDS_SLI
 
@@ -889,6 +891,174 @@ iocard_css_sli = """\
 """
 
 
+# CLIENT-SIDE MASKS
+
+# AO/OA cards whose mask fields are empty render their masks from the
+# original mask, see update_client_masks()
+CLIENT_MASK_TYPES = ('ao', 'oa')
+client_masks_start = "<!-- IO ArMOD client masks start -->"
+client_masks_end = "<!-- IO ArMOD client masks end -->"
+
+client_masks_script = client_masks_start + """
+<div id="io-client-mask" style="display:none" data-side="%(side)s"
+     data-occl-tp="%(occl_tp)s" data-qfill="%(qfill)s"
+     data-note-id="{{text:%(note_id)s}}">{{%(svg)s}}</div>
+<script>
+// Derive the mask of this card from the original mask, unless a mask
+// was generated for it
+(function() {
+  var data = document.getElementById('io-client-mask');
+  var overlay = document.getElementById('io-overlay');
+  var omask = data && data.querySelector('img');
+  if (!overlay || !omask || overlay.querySelector('img'))
+    return;
+  var original = document.querySelector('#io-original');
+  var side = data.dataset.side, occlTp = data.dataset.occlTp;
+  var show = function() { original.style.visibility = "visible"; };
+  var fallback = function(error) {
+    // e.g. fetch() isn't allowed: show the original mask as it is, which
+    // occludes more than the card asks for, never the unmasked image
+    console.log('io client masks: ' + error);
+    var mask = omask.cloneNode();
+    mask.addEventListener('load', show);
+    overlay.appendChild(mask);
+  };
+  original.style.visibility = "hidden";
+
+  var markQuestion = function(node) {
+    if (node.tagName === 'text')
+      return;
+    node.setAttribute('class', 'qshape');
+    if (node.hasAttribute('fill')) {
+      node.setAttribute('class', 'qshape io-qfill');
+      node.setAttribute('fill', data.dataset.qfill);
+    }
+    Array.prototype.forEach.call(node.children, markQuestion);
+  };
+
+  fetch(omask.getAttribute('src')).then(function(response) {
+    return response.text();
+  }).then(function(text) {
+    var svg = new DOMParser().parseFromString(text, 'image/svg+xml').documentElement;
+    var layers = svg.querySelectorAll(':scope > g');
+    var mlayer = layers[layers.length - 1]; // topmost layer holds the masks
+    Array.prototype.slice.call(mlayer.children).forEach(function(shape) {
+      if (shape.tagName === 'title')
+        return;
+      var target = shape.getAttribute('id') === data.dataset.noteId;
+      if (target && side === 'Q')
+        markQuestion(shape);
+      else if (target || occlTp === 'oa')
+        mlayer.removeChild(shape);
+    });
+    if (!svg.hasAttribute('viewBox'))
+      svg.setAttribute('viewBox', '0 0 ' + svg.getAttribute('width') + ' ' +
+                       svg.getAttribute('height'));
+    svg.style.maxWidth = '100%%';
+    svg.style.height = 'auto';
+    overlay.appendChild(svg);
+  }).then(show, fallback);
+})();
+</script>
+""" + client_masks_end
+
+
+# MASK COLOURS
+
+# colours of generated masks that can be changed in the note type CSS,
+# masks.fillClass() gives the class of the shapes they fill
+MASK_COLOURS = ('qfill', 'rev_qfill', 'afill', 'rev_afill', 'hider_fill',
+                'blankq_fill')
+MASK_COLOUR_TYPES = ('ao', 'oa', 'si') # note types showing SVG masks
+mask_colours_start = "/* IO ArMOD mask colours start - updated by the add-on */"
+mask_colours_end = "/* IO ArMOD mask colours end */"
+inline_masks_start = "<!-- IO ArMOD inline masks start -->"
+inline_masks_end = "<!-- IO ArMOD inline masks end -->"
+
+inline_masks_script = inline_masks_start + """
+<script>
+// Inline SVG masks so that the mask colours of the note type CSS apply,
+// an <img> keeps the colours the mask was generated with
+(function() {
+  var original = document.querySelector('#io-original');
+  var masks = document.querySelectorAll('#io-overlay>img[src$=".svg"]');
+  Array.prototype.forEach.call(masks, function(mask) {
+    fetch(mask.getAttribute('src')).then(function(response) {
+      return response.text();
+    }).then(function(text) {
+      var svg = new DOMParser().parseFromString(text, 'image/svg+xml').documentElement;
+      if (svg.tagName !== 'svg')
+        return;
+      if (!svg.hasAttribute('viewBox'))
+        svg.setAttribute('viewBox', '0 0 ' + svg.getAttribute('width') + ' ' +
+                         svg.getAttribute('height'));
+      svg.style.maxWidth = '100%';
+      svg.style.height = 'auto';
+      mask.parentNode.replaceChild(svg, mask);
+      if (original)
+        original.style.visibility = "visible";
+    }).catch(function() {});
+  });
+})();
+</script>
+""" + inline_masks_end
+
+
+def mask_colours_css(sconf):
+    """CSS block defining the mask colours of sconf"""
+    keys = [key for key in MASK_COLOURS if key in sconf] # older configs lack some
+    lines = [mask_colours_start, ".card {"]
+    for key in keys:
+        lines.append("  --io-%s: #%s;" % (key.replace('_', '-'), sconf[key]))
+    lines.append("}")
+    for key in keys:
+        name = key.replace('_', '-')
+        lines.append("#io-overlay .io-%s { fill: var(--io-%s); }" % (name, name))
+    lines.append(mask_colours_end)
+    return "\n".join(lines)
+
+
+def replace_block(text, start, end, block):
+    """Replace the block between start and end markers in text or append it"""
+    if start in text:
+        (head, rest) = text.split(start, 1)
+        text = head.rstrip('\n') + rest.split(end, 1)[-1]
+    return text + "\n" + block
+
+
+# CLIPPED IMAGES
+
+# LI/SLI cards in the 'clip' image mode show their region of the shared
+# source image, the per card geometry is set inline in the image fields
+clip_imgs_start = "/* IO ArMOD clipped images start - updated by the add-on */"
+clip_imgs_end = "/* IO ArMOD clipped images end */"
+clip_imgs_css = clip_imgs_start + """
+.io-clip {
+  position: relative;
+  display: inline-block;
+  overflow: hidden;
+  width: 100%;
+  vertical-align: top;
+}
+.io-clip > img {
+  position: absolute;
+  max-width: none;
+  max-height: none;
+  height: auto;
+}
+""" + clip_imgs_end
+
+
+def update_clip_imgs(col, io_model):
+    """Add the CSS showing clipped images to io_model, it is never removed again"""
+    css = replace_block(io_model['css'], clip_imgs_start, clip_imgs_end, clip_imgs_css)
+    if css != io_model['css']:
+        logging.debug(f'updating clipped images of {io_model["name"]}')
+        io_model['css'] = css
+        col.models.save(io_model)
+    return io_model
+
+
 # INCREMENTAL UPDATES
 
 html_overlay_onload = """\
@@ -1007,4 +1177,54 @@ def update_template(col, old_version, model_map):
     col.models.save()
     return io_model
 
+
+def update_client_masks(col, io_model, occl_tp, ioflds, qfill):
+    """
+    Add the client-side mask script to io_model or refresh it. It is
+    never removed again, it does nothing on cards with generated masks.
+    """
+    template = io_model['tmpls'][0]
+    changed = False
+    for key, side in (('qfmt', 'Q'), ('afmt', 'A')):
+        fmt = replace_block(template[key], client_masks_start, client_masks_end,
+                            client_masks_script % {
+                                'side': side, 'occl_tp': occl_tp, 'qfill': qfill,
+                                'note_id': ioflds['id'], 'svg': ioflds['om']})
+        if fmt != template[key]:
+            template[key] = fmt
+            changed = True
+    if changed:
+        logging.debug(f'updating client masks of {io_model["name"]}')
+        col.models.save(io_model)
+    return io_model
+
+
+def template_fields(io_model):
+    """Names of the fields the card templates of io_model refer to"""
+    fields = set()
+    for template in io_model['tmpls']:
+        for fmt in (template['qfmt'], template['afmt']):
+            for ref in re.findall(r"{{\s*[#^/]?\s*([^{}]+?)\s*}}", fmt):
+                fields.add(ref.split(':')[-1].strip()) # strip filters
+    return fields
+
+
+def update_mask_colours(col, io_model, sconf):
+    """
+    Write the mask colours of sconf to the CSS of io_model and make its
+    templates inline SVG masks, so that the colours apply to all cards
+    """
+    template = io_model['tmpls'][0]
+    css = replace_block(io_model['css'], mask_colours_start, mask_colours_end,
+                        mask_colours_css(sconf))
+    qfmt = replace_block(template['qfmt'], inline_masks_start, inline_masks_end,
+                         inline_masks_script)
+    afmt = replace_block(template['afmt'], inline_masks_start, inline_masks_end,
+                         inline_masks_script)
+    if (css, qfmt, afmt) != (io_model['css'], template['qfmt'], template['afmt']):
+        logging.debug(f'updating mask colours of {io_model["name"]}')
+        (io_model['css'], template['qfmt'], template['afmt']) = (css, qfmt, afmt)
+        col.models.save(io_model)
+    return io_model
+
 logging.debug(f'Exiting: {__name__}')
\ No newline at end of file
@@ -18,6 +18,7 @@ import os
 import re
 
 from aqt import mw
+from anki.utils import ids2str
 
 from xml.dom import minidom
 import urllib.parse
@@ -29,6 +30,7 @@ from ._vendor import imghdr
 from ._vendor.imagesize import imagesize
 
 from .consts import *
+from .sessionindex import SessionIndex, SESSION_INDEX_FILE
 
 
 
@@ -63,6 +65,28 @@ def img2path(img, nameonly=False):
     return fpath
 
 
+def readNoteIds(nids, id_fld):
+    """
+    Return (nid, mod, note_id) of the given notes, note_id being the
+    content of field id_fld. All notes are read in a single query.
+    """
+    rows = []
+    id_ords = {} # position of the ID field by model id
+    for nid, mid, mod, flds in mw.col.db.execute(
+            "select id, mid, mod, flds from notes where id in %s" % ids2str(nids)):
+        if mid not in id_ords:
+            fnames = [fld['name'] for fld in mw.col.models.get(mid)['flds']]
+            id_ords[mid] = fnames.index(id_fld) if id_fld in fnames else None
+        if id_ords[mid] is not None:
+            rows.append((nid, mod, flds.split("\x1f")[id_ords[mid]]))
+    return rows
+
+
+def sessionIndex():
+    """Index of the occlusion sessions of the current profile"""
+    return SessionIndex(os.path.join(mw.pm.profileFolder(), SESSION_INDEX_FILE))
+
+
 def imageProp(image_path):
     """Get image width and height"""
     # Vector graphics